@@ -1,75 +1,479 @@
-import numpy as np
-import os
-import torch
-import torch.nn as nn
-from torch.utils import data
-
-import utils
-from model.Networks import unet
-import h5py
-
-
-class SingleH5Dataset(data.Dataset):
-    def __init__(self, h5_path):
-        super().__init__()
-        self.h5_path = h5_path
-        with h5py.File(h5_path, 'r') as f:
-            self.data = f['img'][:]  # Load entire dataset into memory
-
-    def __len__(self):
-        return 1  # Only single file
-
-    def __getitem__(self, index):
-        img = self.data.astype(np.float32)
-        img = torch.from_numpy(img).permute(2, 0, 1)  # CHW format
-        return img, os.path.basename(self.h5_path)
-
-
-name_classes = ['Non-Landslide', 'Landslide']
-epsilon = 1e-14
-
-def importName(modulename, name):
-    """ Import a named object from a module in the context of this function. """
-    try:
-        module = __import__(modulename, globals(), locals(), [name])
-    except ImportError:
-        return None
-    return vars(module)[name]
-
-restore_from=utils.resource_path('exp/batch2500_F1_7383.pth')
-def main(input_file,size, outputdir):
-    snapshot_dir = outputdir
-    if not os.path.exists(snapshot_dir):
-        os.makedirs(snapshot_dir)
-    # Create network
-    model = unet(n_classes=2)
-
-    saved_state_dict = torch.load(restore_from, map_location=torch.device('cpu'))
-    model.load_state_dict(saved_state_dict)
-
-    test_loader = data.DataLoader(
-        SingleH5Dataset(input_file),
-        batch_size=1, shuffle=False, num_workers=0, pin_memory=True
-    )
-    w, h = map(int, size.split(','))
-    input_size = (w, h)
-    interp = nn.Upsample(size=(input_size[1], input_size[0]), mode='bilinear')
-
-    print('Testing..........')
-    model.eval()
-
-    for index, batch in enumerate(test_loader):
-        image, name = batch  # Now gets name from H5 filename
-        name = name[0].replace('.h5', '_mask')  # Clean filename
-
-        with torch.no_grad():
-            pred = model(image)
-
-        _, pred = torch.max(interp(nn.functional.softmax(pred, dim=1)).detach(), 1)
-        pred = pred.squeeze().data.numpy().astype('uint8')
-
-        with h5py.File(os.path.join(snapshot_dir, f"{name}.h5"), 'w') as hf:
-            hf.create_dataset('mask', data=pred)
-
-if __name__ == '__main__':
-    main()
+import argparse
+import glob
+import numpy as np
+import os
+import threading
+import torch
+import torch.nn as nn
+from torch.utils import data
+
+import onnx_backend
+import utils
+from data_processing import count_landslide_pixels, read_img, save_mask_file, save_result_file
+from georeference import read_grid_attrs
+from model.Networks import unet
+from model.Quantization import MIN_AGREEMENT, quantization_agreement, quantize_unet
+from tiling import TILE_OVERLAP, TILE_SIZE, TileAccumulator, iter_windows
+from tracing import array_info, span, traced
+import tracing
+import h5py
+
+
+class SingleH5Dataset(data.Dataset):
+    """
+    Serves the 'img' dataset of one .h5 file, either as the whole scene or,
+    with tile_size set, as overlapping sliding windows.
+    The file is opened lazily on first access in every process, so each DataLoader
+    worker gets its own handle, and only the window being inferred is read.
+    """
+
+    def __init__(self, h5_path, tile_size=None, overlap=TILE_OVERLAP):
+        super().__init__()
+        self.h5_path = h5_path
+        self.tile_size = tile_size
+        self._file = None
+        with h5py.File(h5_path, 'r') as f:
+            self.shape = f['img'].shape
+        if tile_size is None:
+            self.windows = [(0, 0, self.shape[0], self.shape[1])]
+        else:
+            self.windows = list(iter_windows(self.shape[0], self.shape[1], tile_size, overlap))
+
+    def __getstate__(self):
+        # Open HDF5 handles can't be pickled to worker processes
+        state = self.__dict__.copy()
+        state['_file'] = None
+        return state
+
+    def __len__(self):
+        return len(self.windows)
+
+    def read_window(self, row, col, height, width):
+        """
+        Reads one HWC window straight into a float32 buffer
+        """
+        if self._file is None:
+            self._file = h5py.File(self.h5_path, 'r')
+        return read_img(self._file['img'], np.s_[row:row + height, col:col + width, :],
+                        dtype=np.float32)
+
+    def __getitem__(self, index):
+        row, col, height, width = self.windows[index]
+        # permute only changes strides, the CHW tensor shares the HWC buffer
+        img = torch.from_numpy(self.read_window(row, col, height, width)).permute(2, 0, 1)
+        if self.tile_size is None:
+            return img, os.path.basename(self.h5_path)
+        return img, torch.tensor([row, col])
+
+    def close(self):
+        """
+        Closes the file handle of this process
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class H5SceneDataset(data.Dataset):
+    """
+    Serves whole 'img' scenes from several .h5 files, one CHW float32 tensor per file.
+    Files are opened inside __getitem__, so the dataset is safe to use with DataLoader workers.
+    """
+
+    def __init__(self, h5_paths):
+        super().__init__()
+        self.h5_paths = list(h5_paths)
+
+    def __len__(self):
+        return len(self.h5_paths)
+
+    def __getitem__(self, index):
+        with h5py.File(self.h5_paths[index], 'r') as f:
+            img = read_img(f['img'], dtype=np.float32)
+        img = torch.from_numpy(img).permute(2, 0, 1)  # CHW format
+        return img, index
+
+
+name_classes = ['Non-Landslide', 'Landslide']
+epsilon = 1e-14
+
+def importName(modulename, name):
+    """ Import a named object from a module in the context of this function. """
+    try:
+        module = __import__(modulename, globals(), locals(), [name])
+    except ImportError:
+        return None
+    return vars(module)[name]
+
+def predict_tiled(model, input_file, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, n_classes=2,
+                  num_workers=0, progress=None):
+    """
+    Runs the model window by window over the 'img' dataset and blends the
+    overlapping softmax outputs back into one HxW uint8 mask.
+    Scores are kept for one row of tiles only, so besides the uint8 mask peak memory
+    is set by the tile size, not by the scene size.
+    num_workers DataLoader workers read upcoming windows while the model runs.
+    progress(stage, fraction) is called after every tile and may raise to cancel.
+    """
+    dataset = SingleH5Dataset(input_file, tile_size=tile_size, overlap=overlap)
+    accumulator = TileAccumulator(n_classes, dataset.shape[0], dataset.shape[1], overlap)
+    tile_loader = data.DataLoader(dataset, batch_size=1, shuffle=False, num_workers=num_workers)
+
+    done = 0
+    for image, origin in tile_loader:
+        with torch.no_grad():
+            pred = nn.functional.softmax(model(image), dim=1)
+        row, col = origin[0].tolist()
+        accumulator.add(pred[0].numpy(), row, col)
+        done += 1
+        utils.report(progress, "Detecting landslides", done / len(dataset))
+    dataset.close()
+    return accumulator.mask()
+
+
+def predict_scene(input_file, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, checkpoint=None,
+                  quantize=False, backend='torch', num_workers=0, progress=None):
+    """
+    Tiled detection of one scene with the cached predictor of backend,
+    returns the HxW uint8 mask. For backend='onnx' checkpoint names the .onnx file.
+    """
+    if backend == 'onnx':
+        predictor = onnx_backend.get_onnx_predictor(checkpoint)
+        return onnx_backend.predict_tiled(predictor, input_file, tile_size, overlap, progress)
+    model = get_predictor(checkpoint, quantize=quantize, calibration_file=input_file)
+    return predict_tiled(model, input_file, tile_size, overlap, model.n_classes, num_workers,
+                         progress)
+
+
+restore_from=utils.resource_path('exp/batch2500_F1_7383.pth')
+
+
+class Predictor:
+    """
+    Holds a unet that has been loaded, moved to its device and put into eval mode once.
+    Calling the instance runs a no_grad forward pass on a NCHW batch.
+    """
+
+    def __init__(self, checkpoint, device='cpu', n_classes=2):
+        self.checkpoint = checkpoint
+        self.device = torch.device(device)
+        self.n_classes = n_classes
+        self.quantized = False
+        # Mask agreement of the INT8 with the float model on the calibration windows
+        self.agreement = None
+        with span("model_load", checkpoint=os.path.basename(checkpoint)):
+            self.model = unet(n_classes=n_classes)
+            saved_state_dict = torch.load(checkpoint, map_location=self.device)
+            self.model.load_state_dict(saved_state_dict)
+            self.model.to(self.device)
+            self.model.eval()
+
+    def quantize(self, calibration_batches):
+        """
+        Replaces the float network by its INT8 version, calibrated on calibration_batches,
+        and reports on how many pixels of them both models agree.
+        Quantized kernels only exist for the CPU.
+        """
+        self.device = torch.device('cpu')
+        batches = list(calibration_batches)
+        with span("model_quantize") as quantize_span:
+            float_model = self.model.cpu()
+            self.model = quantize_unet(float_model, batches)
+            self.agreement = quantization_agreement(float_model, self.model, batches)
+            quantize_span.set(agreement=self.agreement)
+        self.quantized = True
+        print(f"INT8 masks match the float model on {self.agreement:.2%} "
+              f"of the calibration pixels")
+        if self.agreement < MIN_AGREEMENT:
+            print(f"Warning: below the expected {MIN_AGREEMENT:.0%}, "
+                  "consider running without --quantize")
+
+    def __call__(self, image):
+        with span("forward", quantized=self.quantized, **array_info(image)), torch.no_grad():
+            return self.model(image.to(self.device)).cpu()
+
+
+def calibration_batches(h5_path, tile_size=TILE_SIZE, count=8):
+    """
+    Picks up to count evenly spread, non-overlapping windows of a scene as
+    1xCxHxW calibration batches for quantization.
+    """
+    dataset = SingleH5Dataset(h5_path, tile_size=tile_size, overlap=0)
+    step = max(1, len(dataset) // count)
+    batches = [dataset[index][0].unsqueeze(0).contiguous()
+               for index in range(0, len(dataset), step)][:count]
+    dataset.close()
+    return batches
+
+
+_predictors = {}
+_predictors_lock = threading.Lock()
+
+
+def set_checkpoint(checkpoint):
+    """
+    Swaps the checkpoint used by default for all following detections.
+    """
+    global restore_from
+    restore_from = checkpoint
+
+
+def get_predictor(checkpoint=None, device='cpu', quantize=False, calibration_file=None):
+    """
+    Returns the warm Predictor for checkpoint (default: restore_from), building it on first use.
+    Instances are cached per process and keyed on the file's modification time,
+    so overwriting a checkpoint in place is picked up without a restart.
+    quantize returns the INT8 CPU variant instead. It is calibrated once on
+    windows of calibration_file, which is required when that variant is built.
+    """
+    checkpoint = os.path.abspath(checkpoint or restore_from)
+    device = 'cpu' if quantize else str(device)
+    key = (checkpoint, os.path.getmtime(checkpoint), device, quantize)
+    with _predictors_lock:
+        if key not in _predictors:
+            for stale in [k for k in _predictors
+                          if k[0] == checkpoint and k[2:] == key[2:]]:
+                del _predictors[stale]
+            predictor = Predictor(checkpoint, device)
+            if quantize:
+                if calibration_file is None:
+                    raise ValueError("Quantization needs a calibration_file.")
+                print('Quantizing model..........')
+                predictor.quantize(calibration_batches(calibration_file))
+            _predictors[key] = predictor
+        return _predictors[key]
+
+
+def clear_predictors():
+    """
+    Drops all cached models, e.g. to free memory.
+    """
+    with _predictors_lock:
+        _predictors.clear()
+
+
+def export_onnx(onnx_path=onnx_backend.ONNX_MODEL_PATH, checkpoint=None, opset_version=17):
+    """
+    Exports the float unet of checkpoint (default: restore_from) to ONNX.
+    Batch size, height and width are dynamic, so the file serves tiles and whole scenes alike.
+    """
+    predictor = Predictor(os.path.abspath(checkpoint or restore_from))
+    dummy = torch.zeros(1, predictor.model.n_channels, TILE_SIZE, TILE_SIZE)
+    torch.onnx.export(
+        predictor.model, dummy, onnx_path,
+        input_names=['image'], output_names=['logits'],
+        dynamic_axes={'image': {0: 'batch', 2: 'height', 3: 'width'},
+                      'logits': {0: 'batch', 2: 'height', 3: 'width'}},
+        opset_version=opset_version, dynamo=False)
+    return onnx_path
+
+
+@traced("detection")
+def main(input_file,size, outputdir, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, checkpoint=None,
+         quantize=False, backend='torch', progress=None):
+    """
+    Runs detection on input_file and writes <name>_mask.h5 to outputdir.
+    By default the scene is processed in overlapping tiles of tile_size pixels,
+    tile_size=None pushes the whole scene through the network at once.
+    The network comes from get_predictor, so only the first call pays for loading it.
+    quantize runs the INT8 model, calibrated on input_file the first time it is used.
+    backend='onnx' runs the exported model (checkpoint then names the .onnx file)
+    with ONNX Runtime instead.
+    progress(stage, fraction) is reported per stage and tile and may raise to cancel.
+    """
+    if backend == 'onnx':
+        onnx_backend.main(input_file, size, outputdir, tile_size, overlap, checkpoint, progress)
+        return
+    snapshot_dir = outputdir
+    if not os.path.exists(snapshot_dir):
+        os.makedirs(snapshot_dir)
+    utils.report(progress, "Loading model")
+    model = get_predictor(checkpoint, quantize=quantize, calibration_file=input_file)
+
+    if tile_size is not None:
+        print('Testing..........')
+        pred = predict_tiled(model, input_file, tile_size, overlap, model.n_classes,
+                             progress=progress)
+        write_mask(input_file, pred, snapshot_dir)
+        return
+
+    test_loader = data.DataLoader(
+        SingleH5Dataset(input_file),
+        batch_size=1, shuffle=False, num_workers=0, pin_memory=True
+    )
+    w, h = map(int, size.split(','))
+    input_size = (w, h)
+    interp = nn.Upsample(size=(input_size[1], input_size[0]), mode='bilinear')
+
+    print('Testing..........')
+    utils.report(progress, "Detecting landslides")
+
+    for image, _ in test_loader:
+        pred = model(image)
+
+        _, pred = torch.max(interp(nn.functional.softmax(pred, dim=1)).detach(), 1)
+        pred = pred.squeeze().data.numpy().astype('uint8')
+
+        write_mask(input_file, pred, snapshot_dir)
+
+
+def write_mask(input_file, pred, outputdir):
+    """
+    Writes the HxW uint8 mask to <outputdir>/<name>_mask.h5 and returns the path,
+    plus <name>_mask.tif if the scene is georeferenced
+    """
+    return save_mask_file(input_file, pred, outputdir)
+
+
+def write_results(input_file, pred, outputdir):
+    """
+    Writes <outputdir>/<name>_results.h5 in the same layout the GUI saves in PageThree,
+    plus <name>_results.tif if the scene is georeferenced
+    """
+    with h5py.File(input_file, 'r') as f:
+        base_data = read_img(f['img'])
+        grid = read_grid_attrs(f)
+    mask_array = np.reshape(pred, (pred.shape[0], pred.shape[1], 1))
+    count, percentage = count_landslide_pixels(mask_array)
+    path = os.path.join(outputdir, os.path.basename(input_file).replace('.h5', '_results.h5'))
+    save_result_file(base_data, mask_array, count, percentage, path, grid)
+    return count, percentage
+
+
+def find_scenes(inputs):
+    """
+    Expands directories, globs and file names into a sorted list of base_data .h5 files.
+    Previously written _mask.h5 and _results.h5 files are skipped.
+    """
+    paths = set()
+    for entry in inputs:
+        if os.path.isdir(entry):
+            paths.update(glob.glob(os.path.join(entry, '*.h5')))
+        else:
+            paths.update(glob.glob(entry))
+    return sorted(p for p in paths
+                  if not p.endswith(('_mask.h5', '_results.h5')))
+
+
+def group_by_shape(h5_paths):
+    """
+    Groups scene files by the shape of their 'img' dataset so they can be batched together
+    """
+    groups = {}
+    for path in h5_paths:
+        with h5py.File(path, 'r') as f:
+            groups.setdefault(f['img'].shape, []).append(path)
+    return groups
+
+
+@traced()
+def run_batch(h5_paths, outputdir, batch_size=4, num_workers=2, tile_size=None,
+              overlap=TILE_OVERLAP, checkpoint=None, save_results=True, quantize=False,
+              backend='torch'):
+    """
+    Headless detection over many scenes.
+    Same-sized scenes are stacked into batches and loaded by num_workers DataLoader workers,
+    scenes can also be run one by one in tiled mode by setting tile_size.
+    Writes _mask.h5 (and _results.h5) per scene into outputdir.
+    quantize uses the INT8 model, calibrated on the first scene.
+    backend='onnx' scores scene by scene with ONNX Runtime.
+    """
+    if not os.path.exists(outputdir):
+        os.makedirs(outputdir)
+    if backend == 'onnx':
+        for path in h5_paths:
+            with h5py.File(path, 'r') as f:
+                scene_tile_size = tile_size or max(f['img'].shape[:2])
+            pred = predict_scene(path, scene_tile_size, overlap, checkpoint, backend='onnx')
+            _finish_scene(path, pred, outputdir, save_results)
+        return
+    model = get_predictor(checkpoint, quantize=quantize, calibration_file=h5_paths[0])
+
+    if tile_size is not None:
+        for path in h5_paths:
+            pred = predict_scene(path, tile_size, overlap, checkpoint, quantize,
+                                 num_workers=num_workers)
+            _finish_scene(path, pred, outputdir, save_results)
+        return
+
+    for shape, paths in group_by_shape(h5_paths).items():
+        print(f"Scoring {len(paths)} scene(s) of shape {shape}")
+        loader = data.DataLoader(
+            H5SceneDataset(paths),
+            batch_size=batch_size, shuffle=False, num_workers=num_workers
+        )
+        for images, indices in loader:
+            _, preds = torch.max(nn.functional.softmax(model(images), dim=1), 1)
+            preds = preds.numpy().astype('uint8')
+            for pred, index in zip(preds, indices.tolist()):
+                _finish_scene(paths[index], pred, outputdir, save_results)
+
+
+def _finish_scene(path, pred, outputdir, save_results):
+    write_mask(path, pred, outputdir)
+    if save_results:
+        count, percentage = write_results(path, pred, outputdir)
+        print(f"{os.path.basename(path)}: {count} landslide pixels ({percentage:.2%})")
+    else:
+        print(f"{os.path.basename(path)}: done")
+
+
+def parse_args(argv=None):
+    """
+    Command line options of the headless detection entry point
+    """
+    parser = argparse.ArgumentParser(
+        description="Run landslide detection on base_data .h5 files without the GUI.")
+    parser.add_argument('inputs', nargs='*',
+                        help="Directories, glob patterns or .h5 files containing an 'img' dataset")
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help="Folder for the _mask.h5 and _results.h5 files")
+    parser.add_argument('--batch-size', type=int, default=4,
+                        help="Number of same-sized scenes per forward pass")
+    parser.add_argument('--workers', type=int, default=2,
+                        help="Number of DataLoader worker processes")
+    parser.add_argument('--tile-size', type=int, default=None,
+                        help="Run each scene in tiles of this size instead of batching whole scenes")
+    parser.add_argument('--overlap', type=int, default=TILE_OVERLAP,
+                        help="Overlap between tiles in pixels")
+    parser.add_argument('--checkpoint', default=None,
+                        help="Model weights, defaults to the bundled checkpoint")
+    parser.add_argument('--onnx-model', default=None,
+                        help="ONNX file for --backend onnx, defaults to the bundled or exported one")
+    parser.add_argument('--backend', choices=['torch', 'onnx'], default='torch',
+                        help="Inference engine")
+    parser.add_argument('--export-onnx', metavar='PATH', default=None,
+                        help="Export the checkpoint to an ONNX file first")
+    parser.add_argument('--trace', metavar='PATH', default=None,
+                        help="Write a Chrome trace JSON of all stages to this file")
+    parser.add_argument('--masks-only', action='store_true',
+                        help="Only write _mask.h5 files")
+    parser.add_argument('--quantize', action='store_true',
+                        help="Run the INT8 quantized model on the CPU")
+    return parser.parse_args(argv)
+
+
+def cli(argv=None):
+    """
+    Entry point for headless batch detection
+    """
+    args = parse_args(argv)
+    if args.trace:
+        tracing.enable(args.trace)
+    if args.export_onnx:
+        print(f"Exported ONNX model to {export_onnx(args.export_onnx, args.checkpoint)}")
+        if not args.inputs:
+            return
+    if args.backend == 'onnx':
+        args.checkpoint = args.onnx_model or args.export_onnx
+    h5_paths = find_scenes(args.inputs)
+    if not h5_paths:
+        raise SystemExit("No .h5 scenes found.")
+    print(f"Found {len(h5_paths)} scene(s)")
+    run_batch(h5_paths, args.output_dir, args.batch_size, args.workers,
+              args.tile_size, args.overlap, args.checkpoint, not args.masks_only, args.quantize,
+              args.backend)
+
+
+if __name__ == '__main__':
+    cli()
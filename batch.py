@@ -0,0 +1,305 @@
+"""
+Resumable detection runs over many areas of interest (AOIs).
+The AOIs are listed in a JSON file, e.g.
+
+    [{"name": "innsbruck", "bbox": [11.35, 47.23, 11.45, 47.29],
+      "start": "2024-06-01", "end": "2024-09-01", "max_cloud": 30}]
+
+and every AOI is fetched, stored and scored on a pool of worker processes:
+
+    python batch.py aois.json -o runs --workers 2
+
+Each AOI gets its own folder in the output directory with a state.json that records the
+finished stages. Starting the same run again skips finished AOIs and resumes the others
+at the first stage that did not complete, e.g. after a crash or Ctrl+C.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import re
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import Predict
+import tracing
+import utils
+from copernicus_api import output_grid
+from data_processing import load_base_data, save_hdf5_from_nparray
+from georeference import read_grid
+from tiling import TILE_OVERLAP, TILE_SIZE
+from vectorize import export_polygons
+
+STAGES = ["fetch", "detect"]
+STATE_FILE = "state.json"
+DEFAULT_MAX_CLOUD = 30
+
+AOI = namedtuple("AOI", ["name", "bbox", "start", "end", "max_cloud"])
+# Detection settings shared by all AOIs of a run
+DetectOptions = namedtuple("DetectOptions", ["tile_size", "overlap", "checkpoint", "quantize",
+                                             "backend"])
+
+
+def _parse_day(value, end_of_day=False):
+    if isinstance(value, datetime.datetime):
+        return value
+    day = datetime.date.fromisoformat(str(value))
+    return datetime.datetime.combine(day, datetime.time.max if end_of_day else datetime.time.min)
+
+
+def load_aois(path, start=None, end=None, max_cloud=DEFAULT_MAX_CLOUD):
+    """
+    Reads the AOI list of a job file. start, end and max_cloud are the defaults for
+    AOIs that don't set their own. Raises ValueError for incomplete or duplicate entries.
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        entries = json.load(file)
+    if isinstance(entries, dict):
+        entries = entries.get("aois", [])
+    aois = []
+    for index, entry in enumerate(entries):
+        name = re.sub(r"[^\w.-]+", "_", str(entry.get("name", f"aoi_{index}")))
+        bbox = entry.get("bbox")
+        if bbox is None or len(bbox) != 4:
+            raise ValueError(f"AOI {name} needs a bbox of [minlon, minlat, maxlon, maxlat]")
+        aoi_start, aoi_end = entry.get("start", start), entry.get("end", end)
+        if aoi_start is None or aoi_end is None:
+            raise ValueError(f"AOI {name} needs a start and an end date")
+        aois.append(AOI(name, [float(value) for value in bbox], _parse_day(aoi_start),
+                        _parse_day(aoi_end, end_of_day=True),
+                        float(entry.get("max_cloud", max_cloud))))
+    names = [aoi.name for aoi in aois]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"AOI names must be unique: {', '.join(duplicates)}")
+    return aois
+
+
+def aoi_spec(aoi):
+    """
+    JSON form of the request parameters of aoi. A state recorded for different
+    parameters is discarded, so editing an AOI in the job file fetches it again.
+    """
+    return {"bbox": aoi.bbox, "start": aoi.start.isoformat(), "end": aoi.end.isoformat(),
+            "max_cloud": aoi.max_cloud}
+
+
+def read_state(aoi_dir):
+    """
+    Returns the recorded state of an AOI folder, an empty dict if there is none
+    """
+    try:
+        with open(os.path.join(aoi_dir, STATE_FILE), "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_state(aoi_dir, state):
+    """
+    Replaces the state file atomically, so a crash never leaves a half written one behind
+    """
+    path = os.path.join(aoi_dir, STATE_FILE)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+        json.dump(state, file, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def pending_stages(aoi, state):
+    """
+    Stages of aoi that still have to run given its recorded state. Stages only count as
+    finished while all their outputs exist, and every stage after a pending one reruns.
+    """
+    if state.get("aoi") != aoi_spec(aoi):
+        return list(STAGES)
+    done = state.get("stages", {})
+    for index, stage in enumerate(STAGES):
+        if stage not in done or not all(os.path.exists(path)
+                                        for path in done[stage].get("outputs", [])):
+            return STAGES[index:]
+    return []
+
+
+def _finish_stage(aoi_dir, state, stage, outputs, **results):
+    state["stages"][stage] = {"outputs": outputs, "finished": datetime.datetime.now().isoformat(
+        timespec='seconds'), **results}
+    write_state(aoi_dir, state)
+
+
+def run_aoi(aoi, outputdir, options):
+    """
+    Runs the pending stages of one AOI in outputdir/<name>/ and returns its state.
+    fetch downloads DEM and imagery and stores the normalized, georeferenced <name>.h5,
+    detect writes the mask, the results and <name>_landslides.geojson next to it.
+    Failures are recorded in the state and raised again.
+    """
+    aoi_dir = os.path.join(outputdir, aoi.name)
+    os.makedirs(aoi_dir, exist_ok=True)
+    state = read_state(aoi_dir)
+    stages = pending_stages(aoi, state)
+    if state.get("aoi") != aoi_spec(aoi):
+        state = {"aoi": aoi_spec(aoi), "stages": {}}
+    for stage in stages:
+        state["stages"].pop(stage, None)
+    h5_path = os.path.join(aoi_dir, f"{aoi.name}.h5")
+    try:
+        if "fetch" in stages:
+            _, data = utils.call_for_data(aoi.bbox, aoi.start, aoi.end, aoi.max_cloud,
+                                          visualize=False)
+            if data is None:
+                raise PermissionError("Fetching failed, check the Copernicus credentials")
+            save_hdf5_from_nparray(data, h5_path, grid=output_grid(aoi.bbox))
+            del data
+            _finish_stage(aoi_dir, state, "fetch", [h5_path])
+        if "detect" in stages:
+            pred = Predict.predict_scene(h5_path, options.tile_size, options.overlap,
+                                         options.checkpoint, options.quantize, options.backend)
+            mask_path = Predict.write_mask(h5_path, pred, aoi_dir)
+            count, percentage = Predict.write_results(h5_path, pred, aoi_dir)
+            polygons_path = os.path.join(aoi_dir, f"{aoi.name}_landslides.geojson")
+            polygons = export_polygons(pred, read_grid(h5_path), polygons_path,
+                                       load_base_data(h5_path), normalized=True)
+            _finish_stage(aoi_dir, state, "detect",
+                          [mask_path, h5_path.replace('.h5', '_results.h5'), polygons_path],
+                          landslide_pixels=int(count), percentage=float(percentage),
+                          polygons=polygons)
+    except Exception:
+        state["error"] = traceback.format_exc()
+        write_state(aoi_dir, state)
+        raise
+    state.pop("error", None)
+    write_state(aoi_dir, state)
+    return state
+
+
+def _init_worker(threads, trace):
+    # Every worker runs its own model, so the cores are shared out between them
+    # pylint: disable=import-outside-toplevel
+    import torch
+    torch.set_num_threads(threads)
+    # Workers inherit LANDSLIDE_TRACE, their spans go to the parent instead of that file
+    tracing.disable_export()
+    if trace:
+        tracing.enable()
+    else:
+        tracing.disable()
+
+
+def _run_in_worker(aoi, outputdir, options):
+    """
+    Runs run_aoi in a worker process. Returns its state, or the exception it raised,
+    with the trace events recorded meanwhile and their origin for tracing.merge_events.
+    """
+    tracing.reset()
+    try:
+        result = run_aoi(aoi, outputdir, options)
+    except Exception as e:  # pylint: disable=broad-except
+        result = e
+    return result, tracing.events(), tracing.origin()
+
+
+def run_jobs(aois, outputdir, workers=2, options=None, force=False):
+    """
+    Runs all AOIs with pending stages on workers processes.
+    force discards the recorded states and runs everything again.
+    Returns the names of the finished and of the failed AOIs.
+    """
+    options = options or DetectOptions(TILE_SIZE, TILE_OVERLAP, None, False, 'torch')
+    os.makedirs(outputdir, exist_ok=True)
+    pending = []
+    for aoi in aois:
+        aoi_dir = os.path.join(outputdir, aoi.name)
+        if force and os.path.exists(os.path.join(aoi_dir, STATE_FILE)):
+            os.remove(os.path.join(aoi_dir, STATE_FILE))
+        stages = pending_stages(aoi, read_state(aoi_dir))
+        if stages:
+            pending.append(aoi)
+            print(f"{aoi.name}: {', '.join(stages)}")
+        else:
+            print(f"{aoi.name}: already done")
+    finished = [aoi.name for aoi in aois if aoi not in pending]
+    failed = []
+    if not pending:
+        return finished, failed
+
+    workers = max(1, min(workers, len(pending)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    # Workers are spawned rather than forked, forking a process that runs threads is unsafe
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker,
+                             initargs=(threads, tracing.is_enabled())) as executor:
+        futures = {executor.submit(_run_in_worker, aoi, outputdir, options): aoi
+                   for aoi in pending}
+        try:
+            for future in as_completed(futures):
+                aoi = futures[future]
+                try:
+                    state, events, event_origin = future.result()
+                    tracing.merge_events(events, event_origin)
+                    if isinstance(state, Exception):
+                        raise state
+                except Exception as e:  # pylint: disable=broad-except
+                    failed.append(aoi.name)
+                    print(f"{aoi.name}: failed, {type(e).__name__}: {e}")
+                    continue
+                finished.append(aoi.name)
+                detect = state["stages"]["detect"]
+                print(f"{aoi.name}: {detect['landslide_pixels']} landslide pixels "
+                      f"({detect['percentage']:.2%}), {detect['polygons']} polygon(s)")
+        except KeyboardInterrupt:
+            # Finished stages are recorded, the next run resumes from there
+            for future in futures:
+                future.cancel()
+            raise
+    return finished, failed
+
+
+def parse_args(argv=None):
+    """
+    Command line options of the batch runner
+    """
+    parser = argparse.ArgumentParser(
+        description="Fetch and score many areas of interest, resuming interrupted runs.")
+    parser.add_argument('jobs', help="JSON file listing the AOIs")
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help="Folder that receives one subfolder per AOI")
+    parser.add_argument('--workers', type=int, default=2, help="Number of worker processes")
+    parser.add_argument('--start', default=None, help="Default first day, YYYY-MM-DD")
+    parser.add_argument('--end', default=None, help="Default last day, YYYY-MM-DD")
+    parser.add_argument('--max-cloud', type=float, default=DEFAULT_MAX_CLOUD,
+                        help="Default maximum cloud cover in percent")
+    parser.add_argument('--tile-size', type=int, default=TILE_SIZE,
+                        help="Inference tile size in pixels")
+    parser.add_argument('--overlap', type=int, default=TILE_OVERLAP,
+                        help="Overlap between tiles in pixels")
+    parser.add_argument('--checkpoint', default=None,
+                        help="Model weights (or .onnx file for --backend onnx)")
+    parser.add_argument('--backend', choices=['torch', 'onnx'], default='torch',
+                        help="Inference engine")
+    parser.add_argument('--quantize', action='store_true',
+                        help="Run the INT8 quantized model on the CPU")
+    parser.add_argument('--force', action='store_true',
+                        help="Ignore recorded progress and run every AOI again")
+    return parser.parse_args(argv)
+
+
+def cli(argv=None):
+    """
+    Entry point of the batch runner
+    """
+    args = parse_args(argv)
+    aois = load_aois(args.jobs, args.start, args.end, args.max_cloud)
+    if not aois:
+        raise SystemExit("No AOIs found.")
+    options = DetectOptions(args.tile_size, args.overlap, args.checkpoint, args.quantize,
+                            args.backend)
+    finished, failed = run_jobs(aois, args.output_dir, args.workers, options, args.force)
+    print(f"{len(finished)} of {len(aois)} AOI(s) done")
+    if failed:
+        raise SystemExit(f"Failed: {', '.join(failed)}. Run again to retry them.")
+
+
+if __name__ == '__main__':
+    cli()
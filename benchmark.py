@@ -0,0 +1,284 @@
+"""
+Reproducible benchmarks for the pipeline stages.
+Generates seeded synthetic 14-band cubes, so neither the network nor credentials are needed,
+times every stage and records throughput and peak memory as JSON, e.g.
+
+    python benchmark.py --sizes 256 512 1024 --output bench.json
+    python benchmark.py --output new.json --compare bench.json
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt  # pylint: disable=wrong-import-position
+import numpy as np  # pylint: disable=wrong-import-position
+import torch  # pylint: disable=wrong-import-position
+
+import Predict  # pylint: disable=wrong-import-position
+from data_processing import (concatenate_dem_and_image,  # pylint: disable=wrong-import-position
+                             save_hdf5_from_nparray, visualize_result)
+from model.Networks import unet  # pylint: disable=wrong-import-position
+from tiling import TILE_SIZE  # pylint: disable=wrong-import-position
+
+STAGES = ["concatenate", "save_hdf5", "load_dataset", "forward", "visualize_result"]
+DEFAULT_SIZES = [256, 512, 1024]
+
+
+def synthetic_scene(size, seed=0):
+    """
+    Returns a smooth DEM and a 12-band DN image of size x size pixels with realistic value ranges
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32)
+    dem = 1000 + 300 * np.sin(x / 40) + 200 * np.cos(y / 55) + rng.normal(0, 2, (size, size))
+    image = rng.uniform(0, 4000, (size, size, 12))
+    return dem.astype(np.float32), image.astype(np.float32)
+
+
+def quiet(func):
+    """
+    Wraps func so the diagnostics the stages print don't flood the report
+    """
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return func()
+    return run
+
+
+def measure(func, repeats, trace_memory=True):
+    """
+    Times func over repeats runs, then, with trace_memory, runs it once more under
+    tracemalloc for peak memory. tracemalloc sees numpy allocations but not the internal
+    buffers of torch, so torch stages pass trace_memory=False and report no memory
+    rather than a wrong one, see measure_forward_memory.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    result = {"min_s": min(times), "median_s": statistics.median(times)}
+    if trace_memory:
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_traced_mb"] = peak / 2 ** 20
+    return result
+
+
+def reset_peak_rss():
+    """
+    Resets the peak RSS of this process to its current RSS where the OS allows it (Linux).
+    Returns whether it did.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as file:
+            file.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB.
+    Windows has no resource module and needs the optional psutil package.
+    """
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    try:
+        import resource  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        try:
+            import psutil  # pylint: disable=import-outside-toplevel
+        except ImportError as e:
+            raise ImportError(
+                "Measuring memory on Windows needs psutil: pip install psutil") from e
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def _forward_peak_rss(tile, seed, results):
+    torch.manual_seed(seed)
+    model = unet(n_classes=2).eval()
+    dem, image = synthetic_scene(tile, seed)
+    cube = quiet(lambda: concatenate_dem_and_image(dem, image))()
+    batch = torch.from_numpy(np.ascontiguousarray(cube.transpose(2, 0, 1)[np.newaxis]))
+    reset_peak_rss()
+    before = peak_rss_mb()
+    with torch.no_grad():
+        model(batch)
+    results.put(max(0.0, peak_rss_mb() - before))
+
+
+def measure_forward_memory(tile, seed=0):
+    """
+    Peak memory of one unet forward pass on a tile x tile batch in MB, including the buffers
+    of torch that tracemalloc misses: the growth of the peak RSS of a fresh process over
+    its setup. On Linux the peak is reset right before the pass, elsewhere memory freed
+    during the setup can be reused by the pass and hide part of it.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_forward_peak_rss, args=(tile, seed, results))
+    process.start()
+    peak = results.get()
+    process.join()
+    return peak
+
+
+def benchmark_size(size, stages, repeats, workdir, seed):
+    """
+    Runs the selected stages on one synthetic scene size
+    """
+    dem, image = synthetic_scene(size, seed)
+    cube = quiet(lambda: concatenate_dem_and_image(dem, image))()
+    h5_path = os.path.join(workdir, f"bench_{size}.h5")
+    quiet(lambda: save_hdf5_from_nparray(cube, h5_path))()
+    results = []
+
+    def record(stage, func, pixels=size * size, trace_memory=True, peak_rss=None):
+        if stage not in stages:
+            return
+        result = measure(quiet(func), repeats, trace_memory)
+        result.update({"stage": stage, "size": size,
+                       "megapixels_per_s": pixels / 1e6 / result["min_s"]})
+        if peak_rss is not None:
+            result["peak_rss_mb"] = peak_rss()
+        results.append(result)
+        memory = (f"{result['peak_traced_mb']:8.1f} MB" if "peak_traced_mb" in result
+                  else f"{result['peak_rss_mb']:8.1f} MB RSS")
+        print(f"{stage:>18} {size:>5}px  {result['min_s'] * 1000:9.1f} ms  "
+              f"{result['megapixels_per_s']:8.2f} MP/s  {memory}")
+
+    record("concatenate", lambda: concatenate_dem_and_image(dem, image))
+    record("save_hdf5", lambda: save_hdf5_from_nparray(cube, h5_path))
+
+    def load_dataset():
+        dataset = Predict.SingleH5Dataset(h5_path)
+        _ = dataset[0]
+        dataset.close()
+    record("load_dataset", load_dataset)
+
+    if "forward" in stages:
+        torch.manual_seed(seed)
+        model = unet(n_classes=2).eval()
+        tile = min(size, TILE_SIZE)
+        batch = torch.from_numpy(np.ascontiguousarray(
+            cube[:tile, :tile].transpose(2, 0, 1)[np.newaxis]))
+
+        def forward():
+            with torch.no_grad():
+                model(batch)
+        # The forward pass runs on one inference tile, as Predict.predict_tiled does
+        record("forward", forward, pixels=tile * tile, trace_memory=False,
+               peak_rss=lambda: measure_forward_memory(tile, seed))
+
+    mask = (cube[:, :, 12:13] > np.median(cube[:, :, 12])).astype(np.float32)
+    with_mask = np.concatenate((cube, mask), axis=2)
+
+    def render():
+        fig, _, _ = visualize_result(with_mask)
+        fig.canvas.draw()
+        plt.close(fig)
+    record("visualize_result", render)
+    return results
+
+
+def metadata():
+    """
+    Describes the code revision and environment the numbers were measured on
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+                                ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+    }
+
+
+def compare(results, baseline_path):
+    """
+    Prints the min time of every stage relative to a previous benchmark file
+    """
+    with open(baseline_path, "r", encoding="utf-8") as file:
+        baseline = {(r["stage"], r["size"]): r for r in json.load(file)["results"]}
+    print(f"\nRelative to {baseline_path} (<1 is faster):")
+    for result in results:
+        old = baseline.get((result["stage"], result["size"]))
+        if old:
+            line = (f"{result['stage']:>18} {result['size']:>5}px  "
+                    f"time x{result['min_s'] / old['min_s']:.2f}")
+            for key in ("peak_traced_mb", "peak_rss_mb"):
+                if result.get(key) and old.get(key):
+                    line += f"  memory x{result[key] / old[key]:.2f}"
+            print(line)
+
+
+def parse_args(argv=None):
+    """
+    Command line options of the benchmark
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the landslide pipeline stages.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="Edge lengths of the synthetic scenes in pixels")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write results as JSON to this file")
+    parser.add_argument("--compare", default=None, help="Previous JSON results to compare against")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Runs the benchmark suite
+    """
+    args = parse_args(argv)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes:
+            results.extend(benchmark_size(size, args.stages, args.repeats, workdir, args.seed))
+    report = {"meta": metadata(), "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"Wrote {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+    return report
+
+
+if __name__ == "__main__":
+    main()
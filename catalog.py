@@ -0,0 +1,199 @@
+"""
+Scene discovery through the Catalog API (STAC) of the Copernicus Data Space.
+Lists the Sentinel-2 acquisitions over a bbox with their date, cloud cover and the fraction of
+the bbox they cover, so the best acquisition can be picked before any pixels are downloaded:
+
+    python catalog.py --bbox 11.35 47.23 11.45 47.29 --start 2024-06-01 --end 2024-09-01
+"""
+import argparse
+import datetime
+from collections import namedtuple
+
+import numpy as np
+
+from tracing import span
+
+CATALOG_URL = "https://sh.dataspace.copernicus.eu/api/v1/catalog/1.0.0/search"
+COLLECTION = "sentinel-2-l1c"
+# Items per catalog page, the maximum the service accepts
+PAGE_LIMIT = 100
+# The bbox is sampled on a COVERAGE_SAMPLES x COVERAGE_SAMPLES grid to estimate coverage
+COVERAGE_SAMPLES = 64
+
+# One acquisition: all granules of a UTC day over the bbox
+Acquisition = namedtuple("Acquisition", ["date", "datetime", "cloud_cover", "coverage", "items"])
+
+
+def search_items(oauth, bbox, start_time, end_time, max_cloud_cover=100, collection=COLLECTION):
+    """
+    Returns the catalog items (GeoJSON features) of collection intersecting
+    the (minlon, minlat, maxlon, maxlat) bbox between start_time and end_time
+    with at most max_cloud_cover percent clouds. Follows the result pages.
+    Raises requests.HTTPError if the catalog can't be queried.
+    """
+    body = {
+        "bbox": [float(value) for value in bbox],
+        "datetime": f"{_timestamp(start_time)}/{_timestamp(end_time)}",
+        "collections": [collection],
+        "limit": PAGE_LIMIT,
+        "filter": f"eo:cloud_cover <= {float(max_cloud_cover)}",
+        "filter-lang": "cql2-text",
+        "fields": {"include": ["id", "geometry", "properties.datetime",
+                               "properties.eo:cloud_cover"]},
+    }
+    items = []
+    with span("catalog_search") as search_span:
+        while True:
+            response = oauth.post(CATALOG_URL, json=body)
+            response.raise_for_status()
+            page = response.json()
+            items.extend(page.get("features", []))
+            next_token = page.get("context", {}).get("next")
+            if next_token is None:
+                break
+            body["next"] = next_token
+        search_span.set(items=len(items))
+    return items
+
+
+def _timestamp(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+    if isinstance(value, datetime.date):
+        return value.strftime('%Y-%m-%dT00:00:00Z')
+    return str(value)
+
+
+def bbox_samples(bbox, samples=COVERAGE_SAMPLES):
+    """
+    Returns lon, lat of a samples x samples grid of cell centers inside bbox
+    """
+    min_lon, max_lon = sorted((float(bbox[0]), float(bbox[2])))
+    min_lat, max_lat = sorted((float(bbox[1]), float(bbox[3])))
+    steps = (np.arange(samples) + 0.5) / samples
+    lon, lat = np.meshgrid(min_lon + steps * (max_lon - min_lon),
+                           min_lat + steps * (max_lat - min_lat))
+    return lon.ravel(), lat.ravel()
+
+
+def footprint_contains(geometry, lon, lat):
+    """
+    Even-odd test of the points lon, lat against a GeoJSON (Multi)Polygon, holes included.
+    Returns a boolean array.
+    """
+    polygons = geometry["coordinates"]
+    if geometry["type"] == "Polygon":
+        polygons = [polygons]
+    inside = np.zeros(lon.shape, dtype=bool)
+    for polygon in polygons:
+        for ring in polygon:
+            ring = np.asarray(ring, dtype=float)
+            x, y = ring[:, 0], ring[:, 1]
+            next_x, next_y = np.roll(x, -1), np.roll(y, -1)
+            crosses = (y[:, np.newaxis] > lat) != (next_y[:, np.newaxis] > lat)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                at = x[:, np.newaxis] + (lat - y[:, np.newaxis]) * (
+                    (next_x - x) / (next_y - y))[:, np.newaxis]
+            inside ^= (np.count_nonzero(crosses & (lon < at), axis=0) % 2).astype(bool)
+    return inside
+
+
+def group_acquisitions(items, bbox, samples=COVERAGE_SAMPLES):
+    """
+    Merges the granules of each UTC day into one Acquisition.
+    coverage is the fraction of bbox covered by the union of the granule footprints,
+    cloud_cover the mean cloud cover of the granules weighted by their share of the bbox.
+    """
+    lon, lat = bbox_samples(bbox, samples)
+    days = {}
+    for item in items:
+        properties = item["properties"]
+        day = properties["datetime"][:10]
+        inside = footprint_contains(item["geometry"], lon, lat)
+        days.setdefault(day, []).append((item, inside))
+
+    acquisitions = []
+    for day, granules in days.items():
+        covered = np.logical_or.reduce([inside for _, inside in granules])
+        weights = np.array([inside.sum() for _, inside in granules], dtype=float)
+        clouds = np.array([item["properties"].get("eo:cloud_cover", 100.0)
+                           for item, _ in granules], dtype=float)
+        cloud_cover = (float(np.average(clouds, weights=weights)) if weights.sum()
+                       else float(clouds.mean()))
+        acquisitions.append(Acquisition(
+            date=datetime.date.fromisoformat(day),
+            datetime=min(item["properties"]["datetime"] for item, _ in granules),
+            cloud_cover=cloud_cover,
+            coverage=float(covered.mean()),
+            items=[item["id"] for item, _ in granules]))
+    return acquisitions
+
+
+def rank_acquisitions(acquisitions):
+    """
+    Orders acquisitions best first: by the expected cloud-free share of the bbox,
+    coverage * (1 - cloud_cover / 100), newer acquisitions first on ties
+    """
+    return sorted(acquisitions, key=lambda acquisition: (
+        -round(acquisition.coverage * (1 - acquisition.cloud_cover / 100), 4),
+        -acquisition.date.toordinal()))
+
+
+def find_acquisitions(oauth, bbox, start_time, end_time, max_cloud_cover=100,
+                      collection=COLLECTION):
+    """
+    Lists the acquisitions over bbox in the time window, best first.
+    Only metadata is requested, no pixels.
+    """
+    items = search_items(oauth, bbox, start_time, end_time, max_cloud_cover, collection)
+    return rank_acquisitions(group_acquisitions(items, bbox))
+
+
+def acquisition_window(acquisition):
+    """
+    Start and end of the UTC day of acquisition, to request only its pixels
+    """
+    start = datetime.datetime.combine(acquisition.date, datetime.time.min)
+    return start, start + datetime.timedelta(days=1) - datetime.timedelta(seconds=1)
+
+
+def parse_args(argv=None):
+    """
+    Command line options of the catalog listing
+    """
+    parser = argparse.ArgumentParser(
+        description="List Sentinel-2 acquisitions over a bbox without downloading pixels.")
+    parser.add_argument('--bbox', type=float, nargs=4, required=True,
+                        metavar=('MINLON', 'MINLAT', 'MAXLON', 'MAXLAT'))
+    parser.add_argument('--start', type=datetime.date.fromisoformat, required=True,
+                        help="First day, YYYY-MM-DD")
+    parser.add_argument('--end', type=datetime.date.fromisoformat, required=True,
+                        help="Last day, YYYY-MM-DD")
+    parser.add_argument('--max-cloud', type=float, default=100,
+                        help="Skip granules with more cloud cover in percent")
+    parser.add_argument('--top', type=int, default=10, help="Number of acquisitions to list")
+    return parser.parse_args(argv)
+
+
+def cli(argv=None):
+    """
+    Prints the best acquisitions over a bbox
+    """
+    # Credentials are only needed here, the module itself works with any OAuth2 session
+    # or copernicus_client.CopernicusClient
+    # pylint: disable=import-outside-toplevel
+    from copernicus_api import authenticate_with_copernicus
+    args = parse_args(argv)
+    end = datetime.datetime.combine(args.end, datetime.time.max)
+    acquisitions = find_acquisitions(authenticate_with_copernicus(), args.bbox, args.start, end,
+                                     args.max_cloud)
+    print(f"{len(acquisitions)} acquisition(s)")
+    print(f"{'date':<12}{'clouds':>8}{'coverage':>10}  granules")
+    for acquisition in acquisitions[:args.top]:
+        print(f"{acquisition.date.isoformat():<12}{acquisition.cloud_cover:>7.1f}%"
+              f"{acquisition.coverage:>9.1%}  {len(acquisition.items)}")
+    return acquisitions
+
+
+if __name__ == '__main__':
+    cli()
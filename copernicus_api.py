@@ -1,45 +1,91 @@
 """
 API Interface to Sentinel2 L1C and Sentinel30
 """
+import datetime
 import io
+import math
+
+import numpy as np
 import tifffile
-from oauthlib.oauth2 import BackendApplicationClient
-from pyproj import Transformer
-from requests_oauthlib import OAuth2Session
+from copernicus_client import MAX_CONCURRENT_REQUESTS, get_client
+from dem_cache import get_dem_cache
+from georeference import WGS84, OutputGrid, get_transformer, utm_epsg
+from requestDefinitions import decode_samples
+from response_cache import get_response_cache
+from tracing import array_info, span
+from worker import map_concurrently
 
-import credentials
+PROCESS_API_URL = "https://sh.dataspace.copernicus.eu/api/v1/process"
+# Output pixel size in meters
+RESOLUTION = 10
+# The Process API refuses outputs larger than 2500 pixels per side
+MAX_TILE_PIXELS = 2500
+# Extra pixels fetched around every sub-request and cropped off again, so resampling
+# at the seams sees real neighbours instead of the tile border
+TILE_MARGIN = 8
+# Days until new Sentinel-2 acquisitions show up in the archive. Answers for time ranges
+# that end later may still change and are not cached.
+INGESTION_LATENCY_DAYS = 3
 
 
 def authenticate_with_copernicus():
     """
-    Authenticate with Copernicus Dataspace using credentials from secrets_app.py
+    Returns the shared copernicus_client.CopernicusClient for the saved credentials.
+    The token is only fetched with the first request that misses the caches and reused
+    until shortly before it expires. Raises PermissionError without credentials.
     """
-    client_id, client_secret = credentials.get_credentials()
-    client = BackendApplicationClient(client_id=client_id)
-    oauth = OAuth2Session(client=client)
-    token_url = 'https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token'
-    oauth.fetch_token(
-        token_url=token_url,
-        client_secret=client_secret,
-        include_client_id=True)
-    return oauth
+    return get_client()
 
 
-def fetch_dem_data(oauth, bbox, evalscript, save_as_file=True):
+def output_grid(bbox, resolution=RESOLUTION, epsg=None):
     """
-    Fetch DEM data from Sentinel-30
-    First reprojects from long&lat degrees to meters (EPSG:4326 -> EPSG:32633) since the
-    resolution is in meters and the input in degrees.
-    POSTs request with bbox and requests upsampling
+    Reprojects a (minlon, minlat, maxlon, maxlat) bbox from long&lat degrees to meters
+    in the UTM zone of its center (or epsg) and snaps it outwards to the resolution pixel grid.
+    The densified bbox outline is projected, so the grid covers the bbox in any zone.
+    DEM and imagery requests share this grid, so their pixels line up exactly.
+    """
+    min_lon, max_lon = sorted((float(bbox[0]), float(bbox[2])))
+    min_lat, max_lat = sorted((float(bbox[1]), float(bbox[3])))
+    if epsg is None:
+        epsg = utm_epsg((min_lon + max_lon) / 2, (min_lat + max_lat) / 2)
+    minx, miny, maxx, maxy = get_transformer(WGS84, epsg).transform_bounds(
+        min_lon, min_lat, max_lon, max_lat, densify_pts=21)
+    minx = math.floor(minx / resolution) * resolution
+    miny = math.floor(miny / resolution) * resolution
+    maxx = math.ceil(maxx / resolution) * resolution
+    maxy = math.ceil(maxy / resolution) * resolution
+    width = max(1, round((maxx - minx) / resolution))
+    height = max(1, round((maxy - miny) / resolution))
+    return OutputGrid(minx, maxy, width, height, resolution, epsg)
+
+
+def split_grid(width, height, max_pixels=MAX_TILE_PIXELS - 2 * TILE_MARGIN):
+    """
+    Splits a width x height pixel grid into near-equal windows of at most max_pixels per side.
+    Returns a list of (row_start, row_end, col_start, col_end) windows.
+    """
+    row_edges = np.linspace(0, height, math.ceil(height / max_pixels) + 1).round().astype(int)
+    col_edges = np.linspace(0, width, math.ceil(width / max_pixels) + 1).round().astype(int)
+    return [(int(row_edges[i]), int(row_edges[i + 1]), int(col_edges[j]), int(col_edges[j + 1]))
+            for i in range(len(row_edges) - 1)
+            for j in range(len(col_edges) - 1)]
+
+
+def build_request(grid, window, data, evalscript, margin=0):
+    """
+    Builds the Process API request body for one pixel window of grid,
+    grown by margin pixels on every side.
     """
-    transformer = Transformer.from_crs(
-        "EPSG:4326", "EPSG:32633", always_xy=True)
-    minx, miny = transformer.transform(float(bbox[0]), float(bbox[1]))
-    maxx, maxy = transformer.transform(float(bbox[2]), float(bbox[3]))
-    request = {
+    row_start, row_end, col_start, col_end = window
+    res = grid.resolution
+    minx = grid.minx + (col_start - margin) * res
+    maxx = grid.minx + (col_end + margin) * res
+    maxy = grid.maxy - (row_start - margin) * res
+    miny = grid.maxy - (row_end + margin) * res
+    return {
         "input": {
             "bounds": {
-                "properties": {"crs": "http://www.opengis.net/def/crs/EPSG/0/32633"},
+                "properties": {"crs": f"http://www.opengis.net/def/crs/EPSG/0/{grid.epsg}"},
                 "geometry": {
                     "type": "Polygon",
                     "coordinates": [
@@ -53,20 +99,11 @@ def fetch_dem_data(oauth, bbox, evalscript, save_as_file=True):
                     ]
                 },
             },
-            "data": [
-                {
-                    "type": "dem",
-                    "dataFilter": {"demInstance": "COPERNICUS_30"},
-                    "processing": {
-                        "upsampling": "BILINEAR",
-                        "downsampling": "BILINEAR",
-                    },
-                }
-            ],
+            "data": data,
         },
         "output": {
-            "resx": 10,
-            "resy": 10,
+            "width": col_end - col_start + 2 * margin,
+            "height": row_end - row_start + 2 * margin,
             "responses": [
                 {
                     "identifier": "default",
@@ -76,86 +113,164 @@ def fetch_dem_data(oauth, bbox, evalscript, save_as_file=True):
         },
         "evalscript": evalscript,
     }
-    url = "https://sh.dataspace.copernicus.eu/api/v1/process"
-    response = oauth.post(url, json=request)
-    if response.status_code == 200:
-        if save_as_file:
-            with open("output/out_dem.tiff", "wb") as file:
-                file.write(response.content)
-            return "output/out_dem.tiff"
-        image_data = io.BytesIO(response.content)
-        image = tifffile.imread(image_data)
-        return image
-    print(f"Error: {response.status_code}")
-    print(response.text)
-    return None
+
+
+def is_cacheable(request, now=None):
+    """
+    True if the answer to request can't change anymore: no input has a time range that
+    ends within INGESTION_LATENCY_DAYS of now, so DEM requests always qualify.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    settled = now - datetime.timedelta(days=INGESTION_LATENCY_DAYS)
+    for data in request["input"]["data"]:
+        time_range = data.get("dataFilter", {}).get("timeRange")
+        if time_range is None:
+            continue
+        end = datetime.datetime.fromisoformat(time_range["to"].replace("Z", "+00:00"))
+        if end.tzinfo is None:
+            end = end.replace(tzinfo=datetime.timezone.utc)
+        if end > settled:
+            return False
+    return True
+
+
+def post_process_request(oauth, request, use_cache=True):
+    """
+    POSTs a request to the Process API and returns the TIFF bytes.
+    Identical requests are answered from the on-disk response cache without touching the network,
+    except for time ranges that still receive new acquisitions, see is_cacheable.
+    Raises requests.HTTPError if the request failed.
+    """
+    cache = get_response_cache() if use_cache and is_cacheable(request) else None
+    if cache is not None:
+        content = cache.get(request)
+        if content is not None:
+            return content
+    with span("process_api_request", width=request["output"]["width"],
+              height=request["output"]["height"]) as request_span:
+        response = oauth.post(PROCESS_API_URL, json=request)
+        request_span.set(status=response.status_code, bytes=len(response.content))
+    response.raise_for_status()
+    if cache is not None:
+        cache.put(request, response.content)
+    return response.content
+
+
+def fetch_tiled(oauth, bbox, data, evalscript, use_cache=True, grid=None, encoding=None,
+                progress=None):
+    """
+    Fetches bbox on the shared output grid (or the given one), see fetch_grid.
+    """
+    return fetch_grid(oauth, grid or output_grid(bbox), data, evalscript, use_cache,
+                      encoding=encoding, progress=progress)
+
+
+def fetch_grid(oauth, grid, data, evalscript, use_cache=True, margin=None, encoding=None,
+               progress=None):
+    """
+    Fetches an output grid.
+    Grids larger than the Process API output limit are split into sub-requests that are
+    fetched by a bounded thread pool and stitched into one contiguous array.
+    margin defaults to TILE_MARGIN when the grid is split and 0 otherwise.
+    encoding is the requestDefinitions.BandEncoding evalscript returns its bands in,
+    the samples are then decoded to float32. Without it the samples are returned as received.
+    progress(done, total) is called after every finished sub-request and may raise to
+    cancel, sub-requests that were not sent yet are then dropped.
+    Raises requests.HTTPError if any of the sub-requests failed.
+    """
+    windows = split_grid(grid.width, grid.height)
+    if margin is None:
+        margin = TILE_MARGIN if len(windows) > 1 else 0
+
+    def fetch_window(window):
+        content = post_process_request(
+            oauth, build_request(grid, window, data, evalscript, margin), use_cache)
+        with span("tiff_decode", bytes=len(content)) as decode_span:
+            tile = tifffile.imread(io.BytesIO(content))
+            decode_span.set(**array_info(tile))
+        if margin:
+            tile = tile[margin:-margin, margin:-margin]
+        if encoding is not None:
+            tile = decode_samples(tile, encoding)
+        return tile
+
+    if len(windows) == 1:
+        tile = fetch_window(windows[0])
+        if progress is not None:
+            progress(1, 1)
+        return tile
+
+    print(f"Splitting request into {len(windows)} sub-requests")
+    tiles = map_concurrently(fetch_window, windows, MAX_CONCURRENT_REQUESTS, progress)
+
+    stitched = np.empty((grid.height, grid.width) + tiles[0].shape[2:], dtype=tiles[0].dtype)
+    for (row_start, row_end, col_start, col_end), tile in zip(windows, tiles):
+        stitched[row_start:row_end, col_start:col_end] = tile
+    return stitched
+
+
+def fetch_dem_data(oauth, bbox, evalscript, save_as_file=True, use_cache=True, grid=None,
+                   encoding=None, progress=None):
+    """
+    Fetch DEM data from Sentinel-30
+    First reprojects from long&lat degrees to meters (UTM, see output_grid) since the
+    resolution is in meters and the input in degrees. grid overrides the output grid of bbox.
+    POSTs request with bbox and requests upsampling
+    With use_cache the DEM is assembled from the permanent DEM tile cache and only
+    tiles that were never downloaded before are requested.
+    encoding is the BandEncoding of evalscript and progress(done, total) is reported per
+    tile or sub-request, see fetch_grid.
+    """
+    data = [
+        {
+            "type": "dem",
+            "dataFilter": {"demInstance": "COPERNICUS_30"},
+            "processing": {
+                "upsampling": "BILINEAR",
+                "downsampling": "BILINEAR",
+            },
+        }
+    ]
+    if use_cache:
+        image = get_dem_cache().assemble(
+            grid or output_grid(bbox), evalscript,
+            lambda tile_grid: fetch_grid(oauth, tile_grid, data, evalscript,
+                                         use_cache=False, margin=TILE_MARGIN, encoding=encoding),
+            progress)
+    else:
+        image = fetch_tiled(oauth, bbox, data, evalscript, use_cache, grid, encoding, progress)
+    if image is not None and save_as_file:
+        tifffile.imwrite("output/out_dem.tiff", image)
+        return "output/out_dem.tiff"
+    return image
 
 
 def fetch_sentinel_data_image(
-        oauth, bbox, evalscript, start_time, end_time, cloudcoverpercentage):
+        oauth, bbox, evalscript, start_time, end_time, cloudcoverpercentage, use_cache=True,
+        grid=None, encoding=None, progress=None):
     """
     Fetch Image data from Sentinel2-L1C
-    First reprojects from long&lat degrees to meters (EPSG:4326 -> EPSG:32633) since the
-    resolution is in meters and the input in degrees.
+    First reprojects from long&lat degrees to meters (UTM, see output_grid) since the
+    resolution is in meters and the input in degrees. grid overrides the output grid of bbox.
     POSTs request with bbox and requests upsampling for lower RES bands.
     Also applies filter for date & CC
+    Responses are served from the on-disk cache when the same request was made before,
+    unless the time window ends within INGESTION_LATENCY_DAYS of now.
+    encoding is the BandEncoding of evalscript and progress(done, total) is reported per
+    sub-request, see fetch_grid.
     """
     start_time = start_time.strftime('%Y-%m-%dT%H:%M:%SZ')
     end_time = end_time.strftime('%Y-%m-%dT%H:%M:%SZ')
-    transformer = Transformer.from_crs(
-        "EPSG:4326", "EPSG:32633", always_xy=True)
-    minx, miny = transformer.transform(float(bbox[0]), float(bbox[1]))
-    maxx, maxy = transformer.transform(float(bbox[2]), float(bbox[3]))
-    request = {
-        "input": {
-            "bounds": {
-                "properties": {"crs": "http://www.opengis.net/def/crs/EPSG/0/32633"},
-                "geometry": {
-                    "type": "Polygon",
-                    "coordinates": [
-                        [
-                            [minx, miny],
-                            [maxx, miny],
-                            [maxx, maxy],
-                            [minx, maxy],
-                            [minx, miny]
-                        ]
-                    ]
-                },
-            },
-            "data": [
-                {
-                    "type": "sentinel-2-l1c",
-                    "dataFilter": {
-                        "timeRange": {
-                            "from": start_time,
-                            "to": end_time,
-                        }
-                    },
-                    "maxCloudCover": cloudcoverpercentage,
-                }
-            ],
-        },
-        "output": {
-            "resx": 10,
-            "resy": 10,
-            "responses": [
-                {
-                    "identifier": "default",
-                    "format": {"type": "image/tiff"},
+    data = [
+        {
+            "type": "sentinel-2-l1c",
+            "dataFilter": {
+                "timeRange": {
+                    "from": start_time,
+                    "to": end_time,
                 }
-            ],
-        },
-        "evalscript": evalscript,
-    }
-
-    url = "https://sh.dataspace.copernicus.eu/api/v1/process"
-    response = oauth.post(url, json=request)
-
-    if response.status_code == 200:
-        image_data = io.BytesIO(response.content)
-        image = tifffile.imread(image_data)
-        return image
-    print(f"Error: {response.status_code}")
-    print(response.text)
-    return None
+            },
+            "maxCloudCover": cloudcoverpercentage,
+        }
+    ]
+    return fetch_tiled(oauth, bbox, data, evalscript, use_cache, grid, encoding, progress)
@@ -0,0 +1,196 @@
+"""
+Shared HTTP client for the Copernicus Data Space APIs.
+One OAuth2 session with a connection pool serves every request of the process. The token is
+fetched on the first request and refreshed shortly before it expires, so requests answered
+from the local caches never authenticate. Throttled (429) and failed (5xx) requests are
+retried with exponential backoff, honoring Retry-After, and a semaphore bounds the number of
+requests in flight, e.g. LANDSLIDE_MAX_REQUESTS=2 for accounts with a low rate limit.
+"""
+import email.utils
+import os
+import random
+import threading
+import time
+
+import requests
+from oauthlib.oauth2 import BackendApplicationClient, OAuth2Error
+from requests.adapters import HTTPAdapter
+from requests_oauthlib import OAuth2Session
+
+import credentials
+from tracing import span
+
+TOKEN_URL = ('https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/'
+             'openid-connect/token')
+# Tokens are refreshed this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 60
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("LANDSLIDE_MAX_REQUESTS", 4))
+MAX_RETRIES = 5
+# First backoff delay in seconds, doubled on every retry up to MAX_BACKOFF_SECONDS
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+# Seconds to wait for a response, large Process API outputs take a while
+REQUEST_TIMEOUT = 300
+RETRY_STATUS = frozenset([429, 500, 502, 503, 504])
+
+
+class CopernicusAPIError(requests.HTTPError):
+    """
+    Raised for responses that still fail after all retries
+    """
+
+    def __init__(self, response):
+        super().__init__(f"Copernicus API error {response.status_code} for {response.url}: "
+                         f"{response.text[:500]}", response=response)
+        self.status_code = response.status_code
+
+
+def retry_after(response):
+    """
+    Seconds the Retry-After header of response asks to wait, None without one
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class CopernicusClient:
+    """
+    Thread-safe replacement for an authenticated OAuth2Session: post() and get() take the
+    arguments of requests, return the response and raise CopernicusAPIError for
+    error responses. Raises PermissionError if credentials are missing or rejected.
+    """
+
+    def __init__(self, client_id, client_secret, max_concurrent=MAX_CONCURRENT_REQUESTS,
+                 max_retries=MAX_RETRIES, backoff=BACKOFF_SECONDS, timeout=REQUEST_TIMEOUT):
+        if not client_id or not client_secret:
+            raise PermissionError("No Copernicus credentials saved.")
+        self.client_id = client_id
+        self._client_secret = client_secret
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = OAuth2Session(client=BackendApplicationClient(client_id=client_id))
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=2 * max_concurrent))
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._token_lock = threading.Lock()
+        self._pause_lock = threading.Lock()
+        # Time before which no request is sent, set by Retry-After of throttled responses
+        self._resume_at = 0.0
+
+    def uses(self, client_id, client_secret):
+        """
+        True if the client was created for these credentials
+        """
+        return (client_id, client_secret) == (self.client_id, self._client_secret)
+
+    def ensure_token(self, stale=None):
+        """
+        Returns a token that is valid for at least TOKEN_REFRESH_MARGIN seconds.
+        stale is a token the server rejected, it is replaced unless another thread already did.
+        """
+        with self._token_lock:
+            token = self.session.token
+            if (not token or token is stale
+                    or token.get("expires_at", 0) - TOKEN_REFRESH_MARGIN < time.time()):
+                with span("authenticate"):
+                    try:
+                        token = self.session.fetch_token(
+                            token_url=TOKEN_URL, client_secret=self._client_secret,
+                            include_client_id=True, timeout=self.timeout)
+                    except OAuth2Error as e:
+                        raise PermissionError(f"Copernicus authentication failed: {e}") from e
+            return token
+
+    def backoff_delay(self, attempt):
+        """
+        Exponential backoff with jitter for retry number attempt (0 based)
+        """
+        return min(MAX_BACKOFF_SECONDS, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def _pause(self, seconds):
+        # Throttling applies to the account, so every thread holds off
+        with self._pause_lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    def _wait_for_resume(self):
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def request(self, method, url, **kwargs):
+        """
+        Sends a request with at most max_concurrent requests in flight.
+        Connection errors, timeouts, 429 and 5xx are retried up to max_retries times,
+        an expired or revoked token is replaced once.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        with self._slots:
+            refreshed = False
+            for attempt in range(self.max_retries + 1):
+                self._wait_for_resume()
+                token = self.ensure_token()
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self.backoff_delay(attempt)
+                    print(f"{type(e).__name__}, retrying in {delay:.1f}s")
+                    time.sleep(delay)
+                    continue
+                if response.status_code == 401 and not refreshed:
+                    refreshed = True
+                    self.ensure_token(stale=token)
+                    continue
+                if response.status_code not in RETRY_STATUS or attempt == self.max_retries:
+                    break
+                delay = retry_after(response)
+                if delay is None:
+                    delay = self.backoff_delay(attempt)
+                if response.status_code == 429:
+                    self._pause(delay)
+                print(f"Copernicus API returned {response.status_code}, "
+                      f"retrying in {delay:.1f}s")
+                time.sleep(delay)
+        if not response.ok:
+            raise CopernicusAPIError(response)
+        return response
+
+    def post(self, url, **kwargs):
+        """
+        POSTs to url, see request
+        """
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url, **kwargs):
+        """
+        GETs url, see request
+        """
+        return self.request("GET", url, **kwargs)
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Returns the process-wide CopernicusClient for the saved credentials,
+    created on first use and again when the credentials change
+    """
+    global _default_client
+    client_id, client_secret = credentials.get_credentials()
+    with _default_client_lock:
+        if _default_client is None or not _default_client.uses(client_id, client_secret):
+            _default_client = CopernicusClient(client_id, client_secret)
+        return _default_client
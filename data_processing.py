@@ -3,39 +3,211 @@ Handles all visualizations, concatenations and normalizations.
 A lot of tions.
 """
 
+import os
+
 import h5py
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 from scipy.ndimage import sobel
 
+from georeference import read_grid, write_geotiff, write_grid_attrs
+from tiling import TILE_OVERLAP
+from tracing import array_info, span, traced
+
+DEFAULT_STORAGE = 'float32'
+# Chunk edge of the 'img' dataset. It divides both the inference tile size and the
+# tile stride, so sliding windows read whole chunks.
+HDF5_CHUNK_PIXELS = TILE_OVERLAP
+# lzf ships with h5py and decompresses considerably faster than gzip
+HDF5_COMPRESSION = 'lzf'
+# Rows normalized and written at once by save_hdf5_from_nparray
+NORMALIZE_BLOCK_ROWS = 8 * HDF5_CHUNK_PIXELS
+# Longest edge of the preview images, larger scenes are decimated for display
+PREVIEW_MAX_PIXELS = 512
+# Overview rows built at once by build_overview
+PREVIEW_BLOCK_ROWS = 64
+# Bands shown as red, green and blue in the result overlay
+RGB_BANDS = [3, 2, 1]
+
+# Per-band mean of the training data, used for normalization
+IMG_MEAN = np.array(
+    [1111.81236406,
+     824.63171476,
+     663.41636217,
+     445.17289745,
+     645.8582926,
+     1547.73508126,
+     1960.44401001,
+     1941.32229668,
+     674.07572865,
+     9.04787384,
+     1113.98338755,
+     519.90397929,
+     20.29228266,
+     772.83144788])
+
+
+def normalize_img(data, out=None):
+    """
+    Divides base_data by the per-band training mean.
+    out may be data itself to normalize in place.
+    """
+    return np.divide(data, IMG_MEAN.astype(data.dtype, copy=False), out=out)
 
 
-def save_hdf5_from_nparray(data, path):
+def save_hdf5_from_nparray(data, path, storage=DEFAULT_STORAGE, grid=None):
     """
     Save normalized base_data to HDF5 file.
-    This is the 'img' dataset
-    """
-    img_mean = np.array(
-        [1111.81236406,
-         824.63171476,
-         663.41636217,
-         445.17289745,
-         645.8582926,
-         1547.73508126,
-         1960.44401001,
-         1941.32229668,
-         674.07572865,
-         9.04787384,
-         1113.98338755,
-         519.90397929,
-         20.29228266,
-         772.83144788])
-    reshaped_mean = img_mean[np.newaxis, np.newaxis, :]
-    data = data / reshaped_mean
-    print(data)
-    with h5py.File(path, "w") as h5file:
-        h5file.create_dataset("img", data.shape, dtype='float64', data=data)
+    This is the 'img' dataset, grid (the OutputGrid the data was fetched on)
+    is stored as file attributes if given
+    storage selects the on-disk layout:
+    'float32' - float32, chunked and compressed (default)
+    'uint16' - per-band linearly scaled uint16, chunked and compressed
+    'float64' - legacy contiguous, uncompressed float64
+    Use read_img to load the dataset independent of its layout.
+    Normalization is done in row blocks while writing, so no normalized copy
+    of the whole cube is held in memory.
+    """
+    if storage not in ('float32', 'uint16', 'float64'):
+        raise ValueError(f"Unknown storage mode: {storage}")
+    with span("hdf5_write", storage=storage, **array_info(data)), h5py.File(path, "w") as h5file:
+        if grid is not None:
+            write_grid_attrs(h5file, grid)
+        if storage == 'float64':
+            dataset = h5file.create_dataset("img", data.shape, dtype='float64')
+        else:
+            chunks = (min(HDF5_CHUNK_PIXELS, data.shape[0]),
+                      min(HDF5_CHUNK_PIXELS, data.shape[1]),
+                      data.shape[2])
+            dataset = h5file.create_dataset("img", data.shape, dtype=storage, chunks=chunks,
+                                            compression=HDF5_COMPRESSION, shuffle=True)
+        if storage == 'uint16':
+            # The mean is positive, so min and max commute with the normalization
+            offset = data.min(axis=(0, 1)) / IMG_MEAN
+            scale = (data.max(axis=(0, 1)) / IMG_MEAN - offset) / 65535
+            scale[scale == 0] = 1
+            dataset.attrs["scale_factor"] = scale
+            dataset.attrs["add_offset"] = offset
+        for row in range(0, data.shape[0], NORMALIZE_BLOCK_ROWS):
+            block = normalize_img(np.asarray(data[row:row + NORMALIZE_BLOCK_ROWS],
+                                             dtype=np.float64))
+            if storage == 'uint16':
+                block -= offset
+                block /= scale
+                block = np.rint(block)
+            dataset[row:row + NORMALIZE_BLOCK_ROWS] = block
+
+
+def read_img(dataset, selection=Ellipsis, dtype=None):
+    """
+    Reads selection of an 'img' dataset written by save_hdf5_from_nparray as float array.
+    Handles all storage modes, scaled uint16 data is expanded to float32.
+    Only the chunks touched by selection are read and decompressed.
+    With dtype set, HDF5 converts straight into a single buffer of that type,
+    so no second full-size copy is made for the conversion.
+    """
+    scaled = "scale_factor" in dataset.attrs
+    if scaled:
+        dtype = np.float32
+    if dtype is None:
+        return dataset[selection]
+    # Zero-stride view, used only to get the shape of the selection without allocating
+    shape = np.broadcast_to(np.empty((), dtype=bool), dataset.shape)[selection].shape
+    img = np.empty(shape, dtype=dtype)
+    dataset.read_direct(img, source_sel=None if selection is Ellipsis else selection)
+    if scaled:
+        img *= dataset.attrs["scale_factor"].astype(np.float32)
+        img += dataset.attrs["add_offset"].astype(np.float32)
+    return img
+
+
+def load_base_data(h5_file):
+    """
+    Reads the 'img' dataset of a base_data .h5 file into memory
+    """
+    with span("hdf5_read") as read_span, h5py.File(h5_file, 'r') as h5file:
+        data = read_img(h5file['img'])
+        read_span.set(**array_info(data))
+    return data
+
+
+def overview_factors(shape, max_size=None):
+    """
+    Returns the (row, col) decimation factors that bring an AxB(xC) shape down to
+    at most max_size pixels along its longer edge
+    """
+    max_size = max_size or PREVIEW_MAX_PIXELS
+    factor = max(1, -(-max(shape[0], shape[1]) // max_size))
+    return min(factor, shape[0]), min(factor, shape[1])
+
+
+def build_overview(source, max_size=None, reduce='mean', factors=None):
+    """
+    Decimates an AxB(xC) numpy array or 'img' h5py dataset to at most max_size pixels
+    along its longer edge, or by the given (row, col) factors.
+    Every overview pixel is the mean (or, with reduce='max', the maximum,
+    which keeps small mask areas visible) of a factor x factor block.
+    The source is read PREVIEW_BLOCK_ROWS overview rows at a time, so only a small band of
+    full resolution data is in memory at once.
+    Returns the float32 overview and the (row, col) factors.
+    """
+    if factors is None:
+        factors = overview_factors(source.shape, max_size)
+    row_factor, col_factor = min(factors[0], source.shape[0]), min(factors[1], source.shape[1])
+    height, width = source.shape[0] // row_factor, source.shape[1] // col_factor
+    reducer = np.max if reduce == 'max' else np.mean
+    overview = np.empty((height, width) + tuple(source.shape[2:]), dtype=np.float32)
+    with span("build_overview", factor=row_factor, **array_info(source)):
+        for row in range(0, height, PREVIEW_BLOCK_ROWS):
+            row_end = min(height, row + PREVIEW_BLOCK_ROWS)
+            block = _read_window(source, row * row_factor, row_end * row_factor,
+                                 0, width * col_factor)
+            block = block.reshape((row_end - row, row_factor, width, col_factor)
+                                  + tuple(source.shape[2:]))
+            reducer(block, axis=(1, 3), out=overview[row:row_end])
+    return overview, (row_factor, col_factor)
+
+
+def _read_window(source, row_start, row_end, col_start, col_end):
+    selection = np.s_[row_start:row_end, col_start:col_end]
+    if isinstance(source, h5py.Dataset):
+        return read_img(source, selection, dtype=np.float32)
+    return np.asarray(source[selection], dtype=np.float32)
+
+
+def attach_zoom_detail(ax, shape, load_window, max_size=None, **imshow_kwargs):
+    """
+    Replaces the overview shown in ax by full resolution data once the view is zoomed in
+    to at most max_size pixels per side. The overview must be drawn with
+    extent=(0, B, A, 0), so the axis coordinates are full resolution pixels.
+    load_window(row_start, row_end, col_start, col_end) returns the image of that window,
+    it is only called for the visible window.
+    """
+    max_size = max_size or PREVIEW_MAX_PIXELS
+    state = {"artist": None, "window": None}
+
+    def update(_):
+        x_low, x_high = sorted(ax.get_xlim())
+        y_low, y_high = sorted(ax.get_ylim())
+        window = (max(0, int(np.floor(y_low))), min(shape[0], int(np.ceil(y_high))),
+                  max(0, int(np.floor(x_low))), min(shape[1], int(np.ceil(x_high))))
+        zoomed_in = (0 < window[1] - window[0] <= max_size
+                     and 0 < window[3] - window[2] <= max_size)
+        if window == state["window"] and zoomed_in:
+            return
+        if state["artist"] is not None:
+            state["artist"].remove()
+            state["artist"] = state["window"] = None
+        if zoomed_in:
+            ax.set_autoscale_on(False)
+            state["artist"] = ax.imshow(load_window(*window), interpolation='nearest',
+                                        extent=(window[2], window[3], window[1], window[0]),
+                                        **imshow_kwargs)
+            state["window"] = window
+
+    ax.callbacks.connect('xlim_changed', update)
+    ax.callbacks.connect('ylim_changed', update)
 
 
 def visualize_as_tiles_h5(h5_file, show=True):
@@ -43,115 +215,222 @@ def visualize_as_tiles_h5(h5_file, show=True):
     Creates the plots for the 2x7 Subplot matrix of base_data
     Takes in H5 and handles data-extraction
     """
-    # Open the HDF5 file
-    with h5py.File(h5_file, 'r') as h5file:
-        # Read the dataset (assuming the dataset name is 'img')
-        data = h5file['img'][:]
-
-        # Get the number of bands
-        number_of_bands = data.shape[2]
-
-        # Create subplots for each band
-        fig, axes = plt.subplots(2, 7, figsize=(20, 10))
-        axes = axes.flatten()
-        for i in range(number_of_bands):
-            b = data[:, :, i]
-            ax = axes[i]
-            ax.imshow(b, cmap='gray')
-            ax.set_title(f"Band {i + 1}")
-            ax.axis('off')
-
-    plt.tight_layout()
+    data = load_base_data(h5_file)
+    fig = visualize_as_tiles_np_array(data, cmap='gray')
     return fig, data
 
 
-def visualize_as_tiles_np_array(numpy_array):
+def _plot_band_thumbnails(axes, overview, cmap, titles=True):
+    for i in range(overview.shape[2]):
+        ax = axes[i]
+        ax.imshow(overview[:, :, i], cmap=cmap, interpolation='nearest')
+        if titles:
+            ax.set_title(f"Band {i + 1}")
+        ax.axis('off')
+
+
+@traced("render_figure")
+def visualize_as_tiles_np_array(numpy_array, cmap='viridis', max_size=None):
     """
     Creates the plots for the 2x7 Subplot matrix of base_data
-    Takes in numpy-array
+    Takes in numpy-array (or an 'img' h5py dataset)
+    Every band is shown as a thumbnail of at most max_size pixels,
+    all of them decimated from the cube in one pass.
     """
+    overview, _ = build_overview(numpy_array, max_size)
     # Create 2 rows with 7 subplots each (for 14 bands)
     # Increased height for 2 rows
     fig, axes = plt.subplots(2, 7, figsize=(20, 10))
 
     # Flatten the axes array for easy iteration
-    axes = axes.flatten()
-
-    for i in range(numpy_array.shape[2]):
-        b = numpy_array[:, :, i]
-        ax = axes[i]
-        ax.imshow(b, cmap='viridis')
-        ax.set_title(f"Band {i + 1}")
-        ax.axis('off')
+    _plot_band_thumbnails(axes.flatten(), overview, cmap)
 
     # Adjust layout to prevent overlapping
     plt.tight_layout()
     return fig
 
 
-def visualize_result(numpy_array):
+def rgb_overlay(bands, mask, low, high):
+    """
+    Composes channels 4-3-2 of an AxBx14 block and its mask into one uint8 RGB image,
+    the mask blended in red at half opacity. low and high are the per-channel stretch limits.
+    """
+    rgb = bands[:, :, RGB_BANDS].astype(np.float32)
+    rgb -= low
+    rgb *= np.divide(255, high - low, out=np.zeros_like(low), where=high > low)
+    rgb[:, :, high <= low] = 128
+    np.clip(rgb, 0, 255, out=rgb)
+    # Same result as drawing the mask with alpha=0.5 on top of the image
+    rgb *= 0.5
+    rgb[:, :, 0] += 127.5 * np.asarray(mask, dtype=np.float32).reshape(mask.shape[:2])
+    return rgb.astype(np.uint8)
+
+
+@traced("render_figure")
+def visualize_result(numpy_array, mask=None, max_size=None):
     """
     Creates the plots for the 2x7 + Result Subplot matrix of base_data
     Takes in numpy array and handles data-extraction
+    numpy_array is AxBx15 with the mask as last band, or AxBx14 with the AxB(x1) mask passed
+    separately, which avoids concatenating the cube.
+    Thumbnails and the RGB+mask overlay are drawn from overviews of at most max_size pixels,
+    the overlay switches to full resolution when zoomed in.
     """
+    if mask is None:
+        mask = numpy_array[:, :, 14]
+    mask = mask.reshape(mask.shape[:2])
+    overview, _ = build_overview(numpy_array, max_size)
+    mask_overview, _ = build_overview(mask, max_size, reduce='max')
+
     fig = plt.figure(figsize=(15, 8))
     gridSpecLayout = gridspec.GridSpec(
         3, 7, figure=fig, height_ratios=[1, 1, 2])
 
     # Plot first 14 layers
-    for i in range(14):
-        ax = fig.add_subplot(gridSpecLayout[i // 7, i % 7])
-        ax.imshow(numpy_array[:, :, i], cmap='gray')
-        ax.axis('off')
-
-    # Extract and normalize RGB channels
-    def normalize(channel):
-        min_val, max_val = np.min(channel), np.max(channel)
-        if max_val == min_val:
-            return np.full_like(channel, 128, dtype='uint8')
-        scaled = ((channel - min_val) / (max_val - min_val)
-                  * 255).astype('uint8')
-
-        return scaled
-    red = normalize(numpy_array[:, :, 3])  # Channel 4 as Red
-    green = normalize(numpy_array[:, :, 2])  # Channel 2 as Green
-    blue = normalize(numpy_array[:, :, 1])  # Channel 3 as Blue
+    axes = [fig.add_subplot(gridSpecLayout[i // 7, i % 7]) for i in range(14)]
+    _plot_band_thumbnails(axes, overview[:, :, :14], 'gray', titles=False)
 
-    rgb = np.dstack((red, green, blue))  # Correct order: R-G-B
-    mask = numpy_array[:, :, 14]
-    red_mask = np.zeros_like(rgb, dtype='uint8')
-    red_mask[..., 0] = 255 * mask
+    # Min-max stretch of channels 4-3-2, taken from the overview
+    low = overview[:, :, RGB_BANDS].min(axis=(0, 1))
+    high = overview[:, :, RGB_BANDS].max(axis=(0, 1))
 
     # Plot RGB
     ax_bottom = fig.add_subplot(gridSpecLayout[2, :])
-    ax_bottom.imshow(rgb)
-
-    ax_bottom.imshow(red_mask, alpha=0.5)
+    height, width = mask.shape
+    ax_bottom.imshow(rgb_overlay(overview, mask_overview, low, high),
+                     extent=(0, width, height, 0), interpolation='nearest')
+    attach_zoom_detail(
+        ax_bottom, mask.shape,
+        lambda r0, r1, c0, c1: rgb_overlay(numpy_array[r0:r1, c0:c1], mask[r0:r1, c0:c1],
+                                            low, high),
+        max_size)
     ax_bottom.axis('off')
-    countLandslidePixels = np.sum(mask)
-    percentageLandslidePixels = (
-        countLandslidePixels / float(numpy_array.shape[0] * numpy_array.shape[1]))
+    countLandslidePixels, percentageLandslidePixels = count_landslide_pixels(mask)
 
     return fig, countLandslidePixels, percentageLandslidePixels
 
 
-def concatenate_dem_and_image(dem, image, metadata=None):
+def count_landslide_pixels(mask):
+    """
+    Returns Count and Percentage of Landslide Pixels of an AxB(x1) mask
+    """
+    count = np.sum(mask)
+    percentage = count / float(mask.shape[0] * mask.shape[1])
+    return count, percentage
+
+
+def save_mask_file(input_file, pred, outputdir, geotiff=True):
+    """
+    Writes the HxW uint8 mask to <outputdir>/<name>_mask.h5 and returns the path
+    If input_file carries a grid, it is copied to the mask file and, with geotiff,
+    the mask is also written as georeferenced <name>_mask.tif
+    """
+    name = os.path.basename(input_file).replace('.h5', '_mask')
+    path = os.path.join(outputdir, f"{name}.h5")
+    grid = read_grid(input_file) if os.path.exists(input_file) else None
+    with span("mask_write", **array_info(pred)), h5py.File(path, 'w') as hf:
+        hf.create_dataset('mask', data=pred)
+        if grid is not None:
+            write_grid_attrs(hf, grid)
+    if grid is not None and geotiff:
+        write_geotiff(os.path.join(outputdir, f"{name}.tif"), pred, grid, reduce='max')
+    return path
+
+
+def save_result_file(base_data, mask_data, count, percentage, path, grid=None, geotiff=True):
+    """
+    Saves results to a .h5 file
+    Includes used processing data as well as mask data
+    Saves Count of Pixels and Percentage of Landslide Pixels
+    With grid, the file is georeferenced and, with geotiff, the bands are also written
+    as georeferenced GeoTIFF next to it
+    """
+    with span("results_write", **array_info(base_data)), h5py.File(path, "w") as f:
+        f.create_dataset("mask", data=mask_data)
+        f.create_dataset("img", data=base_data)
+
+        f.attrs["Count of Landslide Pixels"] = count
+        f.attrs["Percentage of Landslide Pixels"] = percentage
+        if grid is not None:
+            write_grid_attrs(f, grid)
+    if grid is not None and geotiff:
+        write_geotiff(os.path.splitext(path)[0] + ".tif", base_data, grid)
+
+
+def compute_slope(dem, out=None):
+    """
+    Computes the slope band from an AxB DEM with 10m pixel spacing.
+    The result is written into out (any float32 AxB array or view) if given,
+    otherwise a new float32 array is returned.
+    """
+    with span("compute_slope", **array_info(dem)):
+        return _compute_slope(dem, out)
+
+
+def _compute_slope(dem, out):
+    dem = np.asarray(dem, dtype=np.float32)
+    slope = sobel(dem, axis=1, mode='nearest', output=np.float32 if out is None else out)
+    if out is not None:
+        slope = out
+    slope_dz_dy = sobel(dem, axis=0, mode='nearest', output=np.float32)
+
+    # tan(sqrt((dx/80)^2 + (dy/80)^2)) * 100, evaluated in place
+    np.square(slope, out=slope)
+    np.square(slope_dz_dy, out=slope_dz_dy)
+    slope += slope_dz_dy
+    np.sqrt(slope, out=slope)
+    slope /= 8 * 10
+    np.tan(slope, out=slope)
+    slope *= 100
+    return slope
+
+
+def concatenate_dem_and_image(dem, image, metadata=None, slope=None, out=None,
+                              block_rows=None, normalize=False):
     """
     Takes in DEM and image-data. Reshapes and concatenates them to be AXBX14 numpy array.
+    A slope that was already computed from the same DEM can be handed in to skip that step.
+    Everything is written into one AxBx14 float32 buffer, out, which is allocated if not given.
+    out can also be an h5py dataset. With block_rows set, the stack is built
+    block_rows rows at a time (the slope uses a one-row halo and matches the full computation),
+    so dem and image may be memory maps or h5py datasets larger than RAM.
+    normalize divides the result by the per-band training mean in the same pass.
     """
     print(image.shape)
-    dem_shape_dim1 = dem.shape[0]
-    dem_shape_dim2 = dem.shape[1]
+    with span("stack_bands", **array_info(image)):
+        return _stack_bands(dem, image, slope, out, block_rows, normalize)
 
-    slope_dz_dx = sobel(dem, axis=1,mode='nearest' )/(8*10)
-    slope_dz_dy = sobel(dem, axis=0,mode='nearest' )/(8*10)
 
-    slope= np.tan(np.sqrt(slope_dz_dx**2+ slope_dz_dy**2))*100
+def _stack_bands(dem, image, slope, out, block_rows, normalize):
+    height, width = dem.shape[0], dem.shape[1]
+    bands = image.shape[2]
+    if out is None:
+        out = np.empty((height, width, bands + 2), dtype=np.float32)
+    if block_rows is None:
+        block_rows = height
+    in_memory = isinstance(out, np.ndarray)
+    # Slope of a block plus its one-row halo, reused by every block
+    scratch = None
 
-    slope = np.array(slope).reshape((dem_shape_dim1, dem_shape_dim2, 1))
-    print("SLOPE")
-    print(slope)
-    dem = np.reshape(dem, (dem_shape_dim1, dem_shape_dim2, 1))
-    data = np.concatenate((image, slope), axis=2)
-    data = np.concatenate((data, dem), axis=2)
-    return data
+    for row in range(0, height, block_rows):
+        row_end = min(height, row + block_rows)
+        block = out[row:row_end] if in_memory else np.empty(
+            (row_end - row, width, bands + 2), dtype=np.float32)
+        block[:, :, :bands] = image[row:row_end]
+        block[:, :, bands + 1] = dem[row:row_end]
+        if slope is not None:
+            block[:, :, bands] = slope[row:row_end]
+        elif block_rows >= height:
+            compute_slope(dem, out=block[:, :, bands])
+        else:
+            halo_start, halo_end = max(0, row - 1), min(height, row_end + 1)
+            if scratch is None:
+                scratch = np.empty((block_rows + 2, width), dtype=np.float32)
+            block_slope = compute_slope(dem[halo_start:halo_end],
+                                        out=scratch[:halo_end - halo_start])
+            block[:, :, bands] = block_slope[row - halo_start:row_end - halo_start]
+        if normalize:
+            normalize_img(block, out=block)
+        if not in_memory:
+            out[row:row_end] = block
+    return out
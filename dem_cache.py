@@ -0,0 +1,120 @@
+"""
+Permanent local cache for COPERNICUS_30 DEM data on a fixed tile grid.
+The DEM does not change over time, so tiles never expire. A bbox is assembled from
+cached tiles and only tiles that are missing on disk are requested.
+"""
+import hashlib
+import math
+import os
+import threading
+
+import numpy as np
+
+from response_cache import CACHE_DIR
+from worker import map_concurrently
+
+# Tile edge length in output pixels, 512 px at 10 m are 5.12 km
+DEM_TILE_PIXELS = 512
+
+
+class DemTileCache:
+    """
+    Stores DEM tiles as .npy files below directory/<epsg>_<resolution>m_<evalscript hash>/.
+    Tile (row, col) covers x in [col * size, (col + 1) * size) and
+    y in [row * size, (row + 1) * size) in projected meters, with size = tile_pixels * resolution.
+    """
+
+    def __init__(self, directory=os.path.join(CACHE_DIR, "dem"), tile_pixels=DEM_TILE_PIXELS,
+                 max_workers=4):
+        self.directory = directory
+        self.tile_pixels = tile_pixels
+        self.max_workers = max_workers
+
+    def _tile_dir(self, grid, evalscript):
+        digest = hashlib.sha256(evalscript.encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.directory, f"{grid.epsg}_{grid.resolution}m_{digest}")
+
+    def tile_path(self, grid, evalscript, tile_row, tile_col):
+        """
+        Path of the .npy file for tile (tile_row, tile_col) in the CRS and resolution of grid
+        """
+        return os.path.join(self._tile_dir(grid, evalscript), f"{tile_row}_{tile_col}.npy")
+
+    def tiles_for_grid(self, grid):
+        """
+        Returns the (tile_row, tile_col) indices of all tiles intersecting grid
+        """
+        size = self.tile_pixels * grid.resolution
+        maxx = grid.minx + grid.width * grid.resolution
+        miny = grid.maxy - grid.height * grid.resolution
+        cols = range(math.floor(grid.minx / size), math.ceil(maxx / size))
+        rows = range(math.floor(miny / size), math.ceil(grid.maxy / size))
+        return [(row, col) for row in rows for col in cols]
+
+    def tile_grid(self, grid, tile_row, tile_col):
+        """
+        Output grid of a single cache tile, in the CRS and resolution of grid
+        """
+        size = self.tile_pixels * grid.resolution
+        return grid._replace(minx=tile_col * size, maxy=(tile_row + 1) * size,
+                             width=self.tile_pixels, height=self.tile_pixels)
+
+    def _store(self, path, tile):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+        np.save(temp_path, tile)
+        os.replace(temp_path, path)
+
+    def assemble(self, grid, evalscript, fetch_tile, progress=None):
+        """
+        Returns the DEM for grid as a height x width array.
+        fetch_tile(tile_grid) is called, concurrently, for every tile that is not cached yet
+        and has to return the tile array or None on errors. Returns None if any fetch failed.
+        progress(done, total) is called after every fetched tile, see
+        worker.map_concurrently. Tiles fetched before an error are not stored.
+        """
+        tiles = self.tiles_for_grid(grid)
+        missing = [tile for tile in tiles
+                   if not os.path.exists(self.tile_path(grid, evalscript, *tile))]
+        if missing:
+            print(f"DEM cache: fetching {len(missing)} of {len(tiles)} tiles")
+            fetched = map_concurrently(lambda tile: fetch_tile(self.tile_grid(grid, *tile)),
+                                       missing, self.max_workers, progress)
+            if any(tile is None for tile in fetched):
+                return None
+            for tile, array in zip(missing, fetched):
+                self._store(self.tile_path(grid, evalscript, *tile), array)
+        else:
+            print(f"DEM cache: all {len(tiles)} tiles cached")
+
+        dem = None
+        for tile_row, tile_col in tiles:
+            array = np.load(self.tile_path(grid, evalscript, tile_row, tile_col))
+            if dem is None:
+                dem = np.empty((grid.height, grid.width) + array.shape[2:], dtype=array.dtype)
+            tile = self.tile_grid(grid, tile_row, tile_col)
+            # Pixel offset of the tile inside the requested grid
+            row_offset = round((grid.maxy - tile.maxy) / grid.resolution)
+            col_offset = round((tile.minx - grid.minx) / grid.resolution)
+            row_start, col_start = max(0, row_offset), max(0, col_offset)
+            row_end = min(grid.height, row_offset + self.tile_pixels)
+            col_end = min(grid.width, col_offset + self.tile_pixels)
+            dem[row_start:row_end, col_start:col_end] = array[
+                row_start - row_offset:row_end - row_offset,
+                col_start - col_offset:col_end - col_offset]
+        return dem
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_dem_cache():
+    """
+    Returns the process-wide DemTileCache, created on first use
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = DemTileCache()
+        return _default_cache
@@ -0,0 +1,145 @@
+"""
+Place search through Nominatim (OpenStreetMap).
+Answers are kept in an on-disk LRU cache, so repeated searches never touch the network,
+concurrent searches for the same place share one request, and requests are spaced by
+MIN_REQUEST_INTERVAL as the usage policy of the public service demands.
+"""
+import json
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+
+import requests
+
+from response_cache import CACHE_DIR, ResponseCache
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+USER_AGENT = 'Landslide-Thesis|ma3608@mci4me.at'
+# The public Nominatim instance allows one request per second
+MIN_REQUEST_INTERVAL = 1.0
+REQUEST_TIMEOUT = 10
+# Outlines are simplified to this tolerance in degrees, about 50 m, which keeps
+# country sized polygons small
+POLYGON_THRESHOLD = 0.0005
+GEOCODE_CACHE_MAX_BYTES = 64 * 1024 ** 2
+
+# bbox is (minlon, minlat, maxlon, maxlat) like the request bboxes, polygon a GeoJSON
+# geometry or None
+Place = namedtuple("Place", ["name", "lat", "lon", "bbox", "polygon"])
+
+
+class RateLimiter:
+    """
+    Spaces calls of wait() at least interval seconds apart across all threads
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        """
+        Blocks until the next call is allowed
+        """
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class Geocoder:
+    """
+    Looks up places by name, see the module docstring
+    """
+
+    def __init__(self, cache=None, interval=MIN_REQUEST_INTERVAL):
+        self.cache = cache or ResponseCache(os.path.join(CACHE_DIR, "geocode"),
+                                            GEOCODE_CACHE_MAX_BYTES)
+        self.limiter = RateLimiter(interval)
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    @staticmethod
+    def request_params(query):
+        """
+        Nominatim parameters for query. Case and spacing don't change the answer,
+        so they are normalized and the cache key stays the same.
+        """
+        return {"q": re.sub(r"\s+", " ", query).strip().casefold(), "format": "json",
+                "limit": 1, "polygon_geojson": 1, "polygon_threshold": POLYGON_THRESHOLD}
+
+    def _fetch(self, params):
+        content = self.cache.get(params)
+        if content is None:
+            self.limiter.wait()
+            response = self.session.get(NOMINATIM_URL, params=params, timeout=REQUEST_TIMEOUT)
+            if response.status_code != 200:
+                raise requests.exceptions.HTTPError(
+                    f"Error fetching bbox: {response.status_code}", response=response)
+            content = response.content
+            self.cache.put(params, content)
+        return json.loads(content)
+
+    def search(self, query):
+        """
+        Returns the best matching Place for query.
+        Raises ValueError if nothing matches and requests.HTTPError if the service fails.
+        """
+        params = self.request_params(query)
+        key = ResponseCache.key(params)
+        with self._lock:
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = self._pending[key] = Future()
+        if owner:
+            try:
+                future.set_result(self._fetch(params))
+            except Exception as e:  # pylint: disable=broad-except
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._pending[key]
+        results = future.result()
+        if not results:
+            raise ValueError("City not found in geocoding service.")
+        return parse_place(results[0])
+
+
+def parse_place(result):
+    """
+    Converts a Nominatim search result into a Place
+    """
+    south, north, west, east = (float(value) for value in result["boundingbox"])
+    return Place(result.get("display_name", ""), float(result["lat"]), float(result["lon"]),
+                 (west, south, east, north), result.get("geojson"))
+
+
+_default_geocoder = None
+_default_geocoder_lock = threading.Lock()
+
+
+def get_geocoder():
+    """
+    Returns the process-wide Geocoder, created on first use
+    """
+    global _default_geocoder
+    with _default_geocoder_lock:
+        if _default_geocoder is None:
+            _default_geocoder = Geocoder()
+        return _default_geocoder
+
+
+def geocode(query):
+    """
+    Looks up query with the shared Geocoder, see Geocoder.search
+    """
+    return get_geocoder().search(query)
@@ -0,0 +1,150 @@
+"""
+Georeferencing of the pixel grids the data is requested on.
+Grids are laid out in the UTM zone of their area, coordinate transformers are created once
+per pair of CRS and shared.
+The grid of a scene is stored as 'crs' and 'transform' attributes in its .h5 files, and masks
+and bands can be written as tiled, compressed GeoTIFFs with internal overviews, which GIS tools
+read window by window and level by level.
+"""
+import functools
+import math
+import os
+from collections import namedtuple
+
+import h5py
+import tifffile
+from pyproj import Transformer
+
+from tracing import array_info, span
+
+# Output pixel grid of a request: top left corner, size in pixels, pixel size and CRS
+OutputGrid = namedtuple("OutputGrid", ["minx", "maxy", "width", "height", "resolution", "epsg"])
+
+WGS84 = 4326
+
+GEOTIFF_TILE_PIXELS = 256
+GEOTIFF_COMPRESSION = 'zlib'
+
+# GeoTIFF tags and keys
+_MODEL_PIXEL_SCALE = 33550
+_MODEL_TIEPOINT = 33922
+_GEO_KEY_DIRECTORY = 34735
+_GT_MODEL_TYPE_PROJECTED = (1024, 0, 1, 1)
+_GT_RASTER_TYPE_PIXEL_IS_AREA = (1025, 0, 1, 1)
+_PROJECTED_CS_TYPE = 3072
+
+
+def utm_epsg(lon, lat):
+    """
+    EPSG code of the WGS84 UTM zone containing lon/lat,
+    including the zone exceptions around Norway and Svalbard
+    """
+    zone = int((lon + 180) // 6) % 60 + 1
+    if 56 <= lat < 64 and 3 <= lon < 12:
+        zone = 32
+    elif 72 <= lat < 84 and 0 <= lon < 42:
+        zone = 31 if lon < 9 else 33 if lon < 21 else 35 if lon < 33 else 37
+    return (32600 if lat >= 0 else 32700) + zone
+
+
+@functools.lru_cache(maxsize=None)
+def get_transformer(source_epsg, target_epsg):
+    """
+    Returns the shared lon/lat-ordered Transformer between two EPSG codes.
+    Creating a Transformer takes milliseconds and pyproj transformers are thread-safe,
+    so every pair is created only once.
+    """
+    return Transformer.from_crs(f"EPSG:{source_epsg}", f"EPSG:{target_epsg}", always_xy=True)
+
+
+def grid_transform(grid):
+    """
+    Affine pixel to CRS transform of grid as (a, b, c, d, e, f), the order rasterio uses:
+    x = a * col + b * row + c, y = d * col + e * row + f
+    """
+    return (float(grid.resolution), 0.0, float(grid.minx),
+            0.0, -float(grid.resolution), float(grid.maxy))
+
+
+def write_grid_attrs(h5_object, grid):
+    """
+    Stores grid as 'crs', 'transform', 'width' and 'height' attributes of an h5py file or dataset
+    """
+    h5_object.attrs["crs"] = f"EPSG:{grid.epsg}"
+    h5_object.attrs["transform"] = grid_transform(grid)
+    h5_object.attrs["width"] = grid.width
+    h5_object.attrs["height"] = grid.height
+
+
+def read_grid_attrs(h5_object):
+    """
+    Returns the OutputGrid stored with write_grid_attrs, or None for files without one
+    """
+    attrs = h5_object.attrs
+    if "crs" not in attrs or "transform" not in attrs:
+        return None
+    epsg = int(str(attrs["crs"]).split(":")[-1])
+    resolution, _, minx, _, _, maxy = (float(value) for value in attrs["transform"])
+    return OutputGrid(minx, maxy, int(attrs["width"]), int(attrs["height"]), resolution, epsg)
+
+
+def read_grid(h5_path):
+    """
+    Returns the OutputGrid of an .h5 file, or None if it carries none
+    """
+    with h5py.File(h5_path, 'r') as h5file:
+        return read_grid_attrs(h5file)
+
+
+def geotiff_tags(grid):
+    """
+    GeoTIFF tags placing the image on grid, as tifffile extratags
+    """
+    keys = [_GT_MODEL_TYPE_PROJECTED, _GT_RASTER_TYPE_PIXEL_IS_AREA,
+            (_PROJECTED_CS_TYPE, 0, 1, int(grid.epsg))]
+    directory = [1, 1, 0, len(keys)] + [value for key in keys for value in key]
+    return [
+        (_MODEL_PIXEL_SCALE, 'd', 3, (float(grid.resolution), float(grid.resolution), 0.0), True),
+        (_MODEL_TIEPOINT, 'd', 6, (0.0, 0.0, 0.0, float(grid.minx), float(grid.maxy), 0.0), True),
+        (_GEO_KEY_DIRECTORY, 'H', len(directory), directory, True),
+    ]
+
+
+def overview_levels(shape, tile=GEOTIFF_TILE_PIXELS):
+    """
+    Decimation factors 2, 4, ... until the overview fits into a single tile
+    """
+    factors = []
+    factor = 2
+    while math.ceil(max(shape[0], shape[1]) / (factor // 2)) > tile:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def write_geotiff(path, data, grid, reduce='mean', tile=GEOTIFF_TILE_PIXELS,
+                  compression=GEOTIFF_COMPRESSION):
+    """
+    Writes an AxB or AxBxC array on grid as tiled, compressed GeoTIFF with internal overviews
+    and returns the path. The overviews follow the full resolution image as reduced-resolution
+    pages, each half the size of the previous one, which is where GDAL looks for them.
+    They are built by block mean or, with reduce='max' for masks, block maximum
+    so small areas stay visible.
+    """
+    # data_processing stores grids through this module
+    from data_processing import build_overview  # pylint: disable=import-outside-toplevel
+    if data.shape[:2] != (grid.height, grid.width):
+        raise ValueError(f"Data of shape {data.shape} does not match the grid "
+                         f"{grid.height}x{grid.width}")
+    options = {"tile": (tile, tile), "compression": compression, "photometric": 'minisblack',
+               "planarconfig": 'contig' if data.ndim == 3 else None, "metadata": None}
+    tmp_path = f"{path}.tmp"
+    with span("geotiff_write", **array_info(data)), tifffile.TiffWriter(tmp_path) as tif:
+        tif.write(data, extratags=geotiff_tags(grid), **options)
+        overview = data
+        for _factor in overview_levels(data.shape, tile):
+            # Every level halves the previous one
+            overview, _ = build_overview(overview, factors=(2, 2), reduce=reduce)
+            tif.write(overview.astype(data.dtype, copy=False), subfiletype=1, **options)
+    os.replace(tmp_path, path)
+    return path
@@ -7,17 +7,23 @@ import os
 from pathlib import Path
 from tkinter import filedialog, messagebox
 import customtkinter
-from tkintermapview import TkinterMapView
 from tkcalendar import DateEntry
 
 import h5py
 import numpy as np
 from customtkinter import DrawEngine
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 import tkinter as tk
-import Predict
-from data_processing import save_hdf5_from_nparray, visualize_result
+import onnx_backend
+from copernicus_api import output_grid
+from geocoding import geocode
+from georeference import read_grid, read_grid_attrs
+from map_tiles import ResultMapView, ResultTiles
+from data_processing import (count_landslide_pixels, save_hdf5_from_nparray,
+                             visualize_as_tiles_np_array, visualize_result, save_result_file)
 from utils import get_bbox_for_city, call_for_data
+from vectorize import export_polygons
+from worker import BackgroundTask
 import credentials
 
 
@@ -37,6 +43,8 @@ class App(customtkinter.CTk):
     file_path = ""
     shape = ""
     data = None
+    grid = None
+    normalized = False
     CONFIG_PATH = os.path.expanduser("~/.myguiapp_config.json")
 
     def __init__(self, *args, **kwargs):
@@ -53,6 +61,8 @@ class App(customtkinter.CTk):
         self.createcommand('tk::mac::Quit', self.on_closing)
 
         self.marker_list = []
+        self.task = None
+        self.create_status_bar()
         container = customtkinter.CTkFrame(self)
         container.pack(side="top", fill="both", expand=True)
         container.grid_rowconfigure(0, weight=1)
@@ -98,6 +108,77 @@ class App(customtkinter.CTk):
         tk.Button(update_win, text="Save", command=update_and_close).grid(row=2, column=0,
                                                                           columnspan=2, pady=10)
 
+    def create_status_bar(self):
+        """
+        Creates the bar at the bottom that shows progress of background jobs and allows cancelling
+        """
+        self.status_bar = customtkinter.CTkFrame(self, height=30)
+        self.status_bar.pack(side="bottom", fill="x")
+        self.status_label = customtkinter.CTkLabel(self.status_bar, text="Ready", anchor="w")
+        self.status_label.pack(side="left", padx=(12, 12), fill="x", expand=True)
+        self.progress_bar = customtkinter.CTkProgressBar(self.status_bar, width=200)
+        self.progress_bar.set(0)
+        self.progress_bar.pack(side="left", padx=(0, 12))
+        self.cancel_button = customtkinter.CTkButton(self.status_bar, text="Cancel", width=80,
+                                                     command=self.cancel_task, state="disabled")
+        self.cancel_button.pack(side="left", padx=(0, 12), pady=4)
+
+    def run_in_background(self, job, args=(), on_done=None):
+        """
+        Runs job(context, *args) on a worker thread while the main loop stays responsive.
+        on_done(result) is called on the main thread once the job finished.
+        Only one job runs at a time.
+        """
+        if self.task is not None and not self.task.finished:
+            messagebox.showinfo("Busy", "Please wait for the running job or cancel it.")
+            return
+
+        def finish(status):
+            self.cancel_button.configure(state="disabled")
+            self.progress_bar.stop()
+            self.progress_bar.configure(mode="determinate")
+            self.progress_bar.set(0)
+            self.status_label.configure(text=status)
+
+        def done(result):
+            finish("Ready")
+            if on_done:
+                on_done(result)
+
+        def failed(error):
+            finish("Failed")
+            messagebox.showerror("Error", str(error))
+
+        self.cancel_button.configure(state="normal")
+        self.task = BackgroundTask(self, job, args,
+                                   on_progress=self.show_progress,
+                                   on_done=done,
+                                   on_error=failed,
+                                   on_cancel=lambda: finish("Cancelled")).start()
+
+    def show_progress(self, stage, fraction=None):
+        """
+        Shows the stage of the running job, with an indeterminate bar if its progress is unknown
+        """
+        self.status_label.configure(text=stage)
+        if fraction is None:
+            if self.progress_bar.cget("mode") != "indeterminate":
+                self.progress_bar.configure(mode="indeterminate")
+                self.progress_bar.start()
+        else:
+            if self.progress_bar.cget("mode") != "determinate":
+                self.progress_bar.stop()
+                self.progress_bar.configure(mode="determinate")
+            self.progress_bar.set(fraction)
+
+    def cancel_task(self):
+        """
+        Cancels the running background job at its next checkpoint
+        """
+        if self.task is not None and not self.task.finished:
+            self.status_label.configure(text="Cancelling...")
+            self.task.cancel()
+
     def set_data(self, data):
         """
         Setter for data
@@ -110,6 +191,30 @@ class App(customtkinter.CTk):
         """
         return self.data
 
+    def set_grid(self, grid):
+        """
+        Setter for the OutputGrid of the current data, None if it is not georeferenced
+        """
+        self.grid = grid
+
+    def get_grid(self):
+        """
+        Getter for grid
+        """
+        return self.grid
+
+    def set_normalized(self, normalized):
+        """
+        Setter for whether the current data was divided by the training mean
+        """
+        self.normalized = normalized
+
+    def get_normalized(self):
+        """
+        Getter for normalized
+        """
+        return self.normalized
+
     def set_shape(self, shapeStr):
         """
         Setter for shape
@@ -158,21 +263,47 @@ class App(customtkinter.CTk):
             page_one = self.pages["PageOne"]
             if option:
                 filepath = page_one.pick_existing_inputfile()
+                if not filepath:
+                    return
                 page.set_file_path(filepath)
                 page.buttonUse.pack()
                 page.buttonSave.pack_forget()
             else:
                 page.buttonUse.pack_forget()
                 page.buttonSave.pack()
-            self.figure, data_selected = self.use_polygon(page_one, filepath)
-            page.controller.set_data(data_selected)
-            # Pass the FIGURE to PageTwo
-            page.set_figure(self.figure)
+
+            params = self.polygon_parameters(page_one, filepath)
+            # Existing files are normalized and carry their grid if they were saved with one
+            grid = read_grid(filepath) if filepath else output_grid(params[0])
+
+            def show_data(data_selected):
+                if data_selected is None:
+                    messagebox.showerror("Error", "No data could be fetched.")
+                    return
+                # Only set once the data arrived, a refused second request must not
+                # replace the grid of the running one
+                self.set_grid(grid)
+                self.set_normalized(bool(filepath))
+                page.controller.set_data(data_selected)
+                # Figures are drawn here on the main thread, Tk is not thread-safe
+                self.figure = visualize_as_tiles_np_array(
+                    data_selected, cmap='gray' if filepath else 'viridis')
+                # Pass the FIGURE to PageTwo
+                page.set_figure(self.figure)
+                page.tkraise()
+
+            self.run_in_background(
+                lambda context: call_for_data(*params, progress=context.progress,
+                                              visualize=False)[1],
+                on_done=show_data)
+            return
         if page_name == "PageThree":
             if option:
                 page.view_file_only()
             else:
+                # Raises the page itself once detection finished
                 page.run_detection()
+                return
         page.tkraise()
 
     def on_closing(self, event=0):
@@ -195,9 +326,10 @@ class App(customtkinter.CTk):
 
         self.mainloop()
 
-    def use_polygon(self, pageOne, path=''):
+    def polygon_parameters(self, pageOne, path=''):
         """
-        Calls for Satellitedata using the selected polygon
+        Collects the call_for_data arguments for the selected polygon or existing file
+        on the main thread, since the Tk widgets must not be read from the worker
         """
         if path == '':
             lat1, long1 = polygonList[0]
@@ -207,10 +339,8 @@ class App(customtkinter.CTk):
             end_date = pageOne.endDate.get_date()
             cloudcover = pageOne.cloudSlider.get()
             print((start_date, end_date, cloudcover))
-            return call_for_data((long1, lat1, long2, lat2),
-                                 start_date, end_date, cloudcover)
-        else:
-            return call_for_data(None, None, None, None, path)
+            return (long1, lat1, long2, lat2), start_date, end_date, cloudcover
+        return None, None, None, None, path
 
 
 class PageOne(customtkinter.CTkFrame):
@@ -307,7 +437,7 @@ class PageOne(customtkinter.CTkFrame):
         self.frame_right.grid_columnconfigure(1, weight=0)
         self.frame_right.grid_columnconfigure(2, weight=1)
 
-        self.map_widget = TkinterMapView(self.frame_right, corner_radius=0)
+        self.map_widget = ResultMapView(self.frame_right, corner_radius=0)
         self.map_widget.grid(row=1, rowspan=1,
                              column=0, columnspan=3,
                              sticky="nswe", padx=(0, 0), pady=(0, 0))
@@ -361,6 +491,9 @@ class PageOne(customtkinter.CTkFrame):
         self.map_widget.add_right_click_menu_command(label="Add polygon corner",
                                                      command=add_marker_event,
                                                      pass_coords=True)
+        self.map_widget.add_right_click_menu_command(
+            label="Remove result overlay",
+            command=lambda: self.map_widget.set_result_tiles(None))
 
     def pick_existing_inputfile(self):
         """
@@ -371,10 +504,14 @@ class PageOne(customtkinter.CTkFrame):
 
     def search_event(self, event=None):
         """
-        Handles user requests to searching WKN
+        Handles user requests to searching WKN, the map is framed to the bbox of the place
         """
-        lat, long = get_bbox_for_city(self.entry.get())
-        self.map_widget.set_position(lat, long)
+        place = geocode(self.entry.get())
+        min_lon, min_lat, max_lon, max_lat = place.bbox
+        if min_lon < max_lon and min_lat < max_lat:
+            self.map_widget.fit_bounding_box((max_lat, min_lon), (min_lat, max_lon))
+        else:
+            self.map_widget.set_position(place.lat, place.lon)
 
     def update_slider_percentage(self, value):
         """
@@ -452,7 +589,8 @@ class PageTwo(customtkinter.CTkFrame):
         if not file_path:
             return
         try:
-            save_hdf5_from_nparray(self.controller.get_data(), file_path)
+            save_hdf5_from_nparray(self.controller.get_data(), file_path,
+                                   grid=self.controller.get_grid())
             self.controller.set_file_path(file_path)
             self.controller.set_shape(str(self.controller.get_data().shape[1]) + "," + str(
                 self.controller.get_data().shape[0]))
@@ -499,6 +637,8 @@ class PageThree(customtkinter.CTkFrame):
         super().__init__(parent)
         self.figure = None
         self.scatter = None
+        self.toolbar = None
+        self.result = None
         self.controller = controller
         self.file_path = ""
         label = customtkinter.CTkLabel(self, text="That worked!")
@@ -506,6 +646,9 @@ class PageThree(customtkinter.CTkFrame):
         button = customtkinter.CTkButton(self, text="Go back main menu",
                                          command=lambda: controller.show_page("PageOne"))
         button.pack(pady=10)
+        self.buttonMap = customtkinter.CTkButton(self, text="Show on map",
+                                                 command=self.show_on_map)
+        self.buttonMap.pack(pady=10)
 
         self.text_display = customtkinter.CTkLabel(
             self, height=20, width=500, text="")
@@ -519,28 +662,51 @@ class PageThree(customtkinter.CTkFrame):
         """
         outputdir = filedialog.askdirectory(
             title="Select an End-Folder!", initialdir=os.getcwd())
-
-        print("rundetection" + self.controller.get_file_path())
-        Predict.main(self.controller.get_file_path(),
-                                        self.controller.get_shape(), outputdir)
-
-        path_to_result = os.path.join(outputdir, Path(
-            self.controller.get_file_path()).stem + "_mask.h5")
-        print("path_to_result" + path_to_result)
-        with h5py.File(path_to_result, "r") as f:
-            mask_array = np.array(f["mask"])
+        if not outputdir:
+            return
+        file_path = self.controller.get_file_path()
+        shape = self.controller.get_shape()
         base_data = self.controller.get_data()
-        save_data_base = base_data
-        mask_array = np.reshape(
-            mask_array, (mask_array.shape[0], mask_array.shape[1], 1))
-        # mask_array = np.rot90(mask_array)
-        base_data = np.concatenate((base_data, mask_array), 2)
-        count_pixels, percentage = self.view_result_file(base_data)
-        path_to_result_set = os.path.join(
-            outputdir,
-            Path(self.controller.get_file_path()).stem + "_results.h5")
-        self.save_result_file(save_data_base, mask_array,
-                              count_pixels, percentage, path_to_result_set)
+        grid = self.controller.get_grid()
+        normalized = self.controller.get_normalized()
+
+        def detect(context):
+            """
+            Runs on the worker thread: detection and saving of the result set
+            """
+            print("rundetection" + file_path)
+            if os.path.exists(onnx_backend.ONNX_MODEL_PATH):
+                onnx_backend.main(file_path, shape, outputdir, progress=context.progress)
+            else:
+                # torch is only imported when no exported ONNX model is bundled
+                import Predict  # pylint: disable=import-outside-toplevel
+                Predict.main(file_path, shape, outputdir, progress=context.progress)
+
+            path_to_result = os.path.join(outputdir, Path(file_path).stem + "_mask.h5")
+            print("path_to_result" + path_to_result)
+            with h5py.File(path_to_result, "r") as f:
+                mask_array = np.array(f["mask"])
+            mask_array = np.reshape(
+                mask_array, (mask_array.shape[0], mask_array.shape[1], 1))
+            # mask_array = np.rot90(mask_array)
+            context.progress("Saving results")
+            count_pixels, percentage = count_landslide_pixels(mask_array)
+            path_to_result_set = os.path.join(
+                outputdir, Path(file_path).stem + "_results.h5")
+            self.save_result_file(base_data, mask_array,
+                                  count_pixels, percentage, path_to_result_set, grid)
+            if grid is not None:
+                context.progress("Exporting landslide polygons")
+                path_to_polygons = os.path.join(
+                    outputdir, Path(file_path).stem + "_landslides.geojson")
+                export_polygons(mask_array, grid, path_to_polygons, base_data, normalized)
+            return mask_array
+
+        def show(mask_array):
+            self.view_result_file(base_data, mask_array)
+            self.tkraise()
+
+        self.controller.run_in_background(detect, on_done=show)
 
     def view_file_only(self):
         """
@@ -554,18 +720,36 @@ class PageThree(customtkinter.CTkFrame):
         with h5py.File(path_to_file, "r") as f:
             mask_array = np.array(f["mask"])
             base_data = np.array(f["img"])
-            mask_array = np.reshape(mask_array,
-                                    (mask_array.shape[0],
-                                     mask_array.shape[1], 1))
-            base_data = np.concatenate((base_data, mask_array), 2)
-            self.view_result_file(base_data)
+            self.controller.set_grid(read_grid_attrs(f))
+            self.view_result_file(base_data, mask_array)
 
-    def view_result_file(self, base_data):
+    def show_on_map(self):
+        """
+        Overlays the current result as map tiles on the map of PageOne
         """
-        Visualizes AxBx15 nparray with :,:,15 being the result mask
+        grid = self.controller.get_grid()
+        if self.result is None or grid is None:
+            messagebox.showerror("Error", "Only georeferenced results can be shown on the map.")
+            return
+        base_data, mask = self.result
+        if mask is None:
+            base_data, mask = base_data[:, :, :14], base_data[:, :, 14]
+        try:
+            result_tiles = ResultTiles(base_data, mask, grid)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        self.controller.pages["PageOne"].map_widget.set_result_tiles(result_tiles)
+        self.controller.show_page("PageOne")
+
+    def view_result_file(self, base_data, mask=None):
+        """
+        Visualizes AxBx15 nparray with :,:,15 being the result mask,
+        or AxBx14 base_data with a separate mask
         Returns Percentage and Count of Pixels
         """
-        self.figure, count_pixels, percentage = visualize_result(base_data)
+        self.figure, count_pixels, percentage = visualize_result(base_data, mask)
+        self.result = (base_data, mask)
 
         text_content = (f"Number of Landslide Pixels: {count_pixels}\n"
                         f"Percentage of Landslide Pixels: {percentage:.2%}")
@@ -573,23 +757,22 @@ class PageThree(customtkinter.CTkFrame):
 
         if self.scatter is not None:
             self.scatter.get_tk_widget().destroy()
+            self.toolbar.destroy()
         self.scatter = FigureCanvasTkAgg(self.figure, self)
+        # Zooming into the overlay loads the visible window at full resolution
+        self.toolbar = NavigationToolbar2Tk(self.scatter, self, pack_toolbar=False)
+        self.toolbar.pack()
         self.scatter.get_tk_widget().pack(pady=10, padx=10)
         self.scatter.draw()
         return count_pixels, percentage
 
-    def save_result_file(self, base_data, mask_data, count, percentage, path):
+    def save_result_file(self, base_data, mask_data, count, percentage, path, grid=None):
         """
         Saves results to a .h5 file
         Includes used processing data as well as mask data
         Saves Count of Pixels and Percentage of Landslide Pixels
         """
-        with h5py.File(path, "w") as f:
-            f.create_dataset("mask", data=mask_data)
-            f.create_dataset("img", data=base_data)
-
-            f.attrs["Count of Landslide Pixels"] = count
-            f.attrs["Percentage of Landslide Pixels"] = percentage
+        save_result_file(base_data, mask_data, count, percentage, path, grid)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,206 @@
+"""
+Slippy-map tiles of detection results for the TkinterMapView of PageOne.
+A result is cut into 256px Web-Mercator (XYZ) tiles on demand: only the tiles the map asks for
+are rendered, each one from the overview level that matches its zoom, and written to a disk
+cache, so panning back or reopening the same result only reads small PNGs.
+"""
+import hashlib
+import math
+import os
+import threading
+
+import numpy as np
+import requests
+from PIL import Image, ImageTk, UnidentifiedImageError
+from tkintermapview import TkinterMapView
+
+from data_processing import RGB_BANDS, build_overview, rgb_overlay
+from georeference import WGS84, get_transformer
+from response_cache import CACHE_DIR
+from tracing import span
+
+TILE_PIXELS = 256
+TILE_CACHE_DIR = os.path.join(CACHE_DIR, "tiles")
+# Web-Mercator ground size of one pixel at zoom 0 on the equator in meters
+MERCATOR_PIXEL_M = 2 * math.pi * 6378137 / TILE_PIXELS
+# Opacity of the RGB composite, the mask is always drawn opaque
+OVERLAY_ALPHA = 200
+
+
+def tile_lonlat(zoom, x, y, tile_pixels=TILE_PIXELS):
+    """
+    Returns longitude and latitude of the pixel centers of XYZ tile (zoom, x, y) as two
+    tile_pixels x tile_pixels arrays
+    """
+    world = tile_pixels * 2 ** zoom
+    offsets = np.arange(tile_pixels) + 0.5
+    lon = (x * tile_pixels + offsets) / world * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y * tile_pixels + offsets) / world))))
+    return np.meshgrid(lon, lat)
+
+
+def tile_range(zoom, bbox):
+    """
+    Returns the inclusive x and y ranges of the XYZ tiles at zoom covering bbox (lon/lat)
+    """
+    n = 2 ** zoom
+
+    def tile_x(lon):
+        return min(n - 1, max(0, int((lon + 180) / 360 * n)))
+
+    def tile_y(lat):
+        lat = math.radians(max(-85.0511, min(85.0511, lat)))
+        return min(n - 1, max(0, int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n)))
+
+    return (tile_x(bbox[0]), tile_x(bbox[2])), (tile_y(bbox[3]), tile_y(bbox[1]))
+
+
+class ResultTiles:
+    """
+    Tile pyramid of an AxBx14 result and its AxB(x1) mask on grid (georeference.OutputGrid).
+    layer 'overlay' shows the RGB composite with the mask in red, 'mask' only the mask.
+    Tiles are rendered when first requested and cached on disk below cache_dir.
+    """
+
+    def __init__(self, base_data, mask, grid, layer='overlay', cache_dir=TILE_CACHE_DIR):
+        if layer not in ('overlay', 'mask'):
+            raise ValueError(f"Unknown layer: {layer}")
+        self.grid = grid
+        mask = mask.reshape(mask.shape[:2])
+        if mask.shape != (grid.height, grid.width):
+            raise ValueError(f"Result of shape {mask.shape} does not match the output grid "
+                             f"{grid.height}x{grid.width}")
+        self.layer = layer
+        self.base_data = base_data
+        self.mask = mask
+        self.transformer = get_transformer(WGS84, grid.epsg)
+        # lon/lat bounds of the snapped grid, slightly larger than the requested bbox
+        lon, lat = self.transformer.transform(
+            [self.grid.minx, self.grid.minx + self.grid.width * self.grid.resolution] * 2,
+            [self.grid.maxy] * 2 + [self.grid.maxy - self.grid.height * self.grid.resolution] * 2,
+            direction="INVERSE")
+        self.bounds = (min(lon), min(lat), max(lon), max(lat))
+        digest = hashlib.sha256(repr((self.grid, layer)).encode())
+        digest.update(np.ascontiguousarray(mask).tobytes())
+        if layer == 'overlay':
+            digest.update(np.ascontiguousarray(base_data[:, :, RGB_BANDS]).tobytes())
+        self.directory = os.path.join(os.path.expanduser(cache_dir), digest.hexdigest()[:24])
+        self._levels = {}
+        self._stretch = None
+        self._lock = threading.Lock()
+
+    def covers(self, zoom, x, y):
+        """
+        True if tile (zoom, x, y) intersects the result
+        """
+        (x_min, x_max), (y_min, y_max) = tile_range(zoom, self.bounds)
+        return x_min <= x <= x_max and y_min <= y <= y_max
+
+    def tile_path(self, zoom, x, y):
+        """
+        Location of the cached PNG of tile (zoom, x, y)
+        """
+        return os.path.join(self.directory, str(zoom), str(x), f"{y}.png")
+
+    def tile(self, zoom, x, y):
+        """
+        Returns tile (zoom, x, y) as RGBA PIL image, or None if it lies outside the result
+        """
+        if not self.covers(zoom, x, y):
+            return None
+        path = self.tile_path(zoom, x, y)
+        if os.path.exists(path):
+            return Image.open(path)
+        with span("render_tile", zoom=zoom):
+            image = Image.fromarray(self.render(zoom, x, y), "RGBA")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        image.save(tmp_path, format="PNG")
+        os.replace(tmp_path, path)
+        return image
+
+    def render(self, zoom, x, y):
+        """
+        Samples tile (zoom, x, y) from the matching overview level as HxWx4 uint8 array
+        """
+        lon, lat = tile_lonlat(zoom, x, y)
+        tile_meters = MERCATOR_PIXEL_M * math.cos(math.radians(float(lat.mean()))) / 2 ** zoom
+        factor = 2 ** max(0, int(math.log2(max(1.0, tile_meters / self.grid.resolution))))
+        image, factors = self.level(factor)
+        easting, northing = self.transformer.transform(lon, lat)
+        cols = np.floor((easting - self.grid.minx) / (self.grid.resolution * factors[1]))
+        rows = np.floor((self.grid.maxy - northing) / (self.grid.resolution * factors[0]))
+        inside = (rows >= 0) & (rows < image.shape[0]) & (cols >= 0) & (cols < image.shape[1])
+        tile = np.zeros(lon.shape + (4,), dtype=np.uint8)
+        tile[inside] = image[rows[inside].astype(np.intp), cols[inside].astype(np.intp)]
+        return tile
+
+    def level(self, factor):
+        """
+        RGBA image of the result decimated by factor, built once per factor
+        """
+        with self._lock:
+            if factor not in self._levels:
+                self._levels[factor] = self._build_level(factor)
+            return self._levels[factor]
+
+    def _build_level(self, factor):
+        max_size = -(-max(self.mask.shape) // factor)
+        mask, factors = build_overview(self.mask, max_size, reduce='max')
+        rgba = np.zeros(mask.shape + (4,), dtype=np.uint8)
+        if self.layer == 'mask':
+            rgba[mask > 0] = (255, 0, 0, 255)
+            return rgba, factors
+        bands, _ = build_overview(self.base_data[:, :, :14], max_size)
+        if self._stretch is None:
+            # One stretch for all levels, so colors don't change while zooming
+            preview, _ = build_overview(self.base_data[:, :, RGB_BANDS])
+            self._stretch = preview.min(axis=(0, 1)), preview.max(axis=(0, 1))
+        rgba[:, :, :3] = rgb_overlay(bands, mask, *self._stretch)
+        rgba[:, :, 3] = np.where(mask > 0, 255, OVERLAY_ALPHA)
+        return rgba, factors
+
+
+class ResultMapView(TkinterMapView):
+    """
+    TkinterMapView that blends the tiles of a ResultTiles pyramid over the base map.
+    Tiles outside the result are loaded exactly as by TkinterMapView.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.result_tiles = None
+        super().__init__(*args, **kwargs)
+
+    def set_result_tiles(self, result_tiles):
+        """
+        Shows result_tiles on the map, None removes the overlay
+        """
+        self.result_tiles = result_tiles
+        # Re-setting the tile server drops the tile cache of the widget and redraws
+        self.set_tile_server(self.tile_server, self.tile_size, self.max_zoom)
+        if result_tiles is not None:
+            min_lon, min_lat, max_lon, max_lat = result_tiles.bounds
+            self.fit_bounding_box((max_lat, min_lon), (min_lat, max_lon))
+
+    def request_image(self, zoom, x, y, db_cursor=None):
+        result_tiles = self.result_tiles
+        overlay = result_tiles.tile(zoom, x, y) if result_tiles is not None else None
+        if overlay is None:
+            return super().request_image(zoom, x, y, db_cursor)
+
+        url = self.tile_server.replace("{x}", str(x)).replace("{y}", str(y)).replace(
+            "{z}", str(zoom))
+        try:
+            image = Image.open(requests.get(url, stream=True, timeout=10,
+                                            headers={"User-Agent": "TkinterMapView"}).raw)
+            image = image.convert("RGBA")
+        except (requests.exceptions.RequestException, UnidentifiedImageError):
+            image = Image.new("RGBA", (self.tile_size, self.tile_size))
+        if image.size != overlay.size:
+            image = image.resize(overlay.size)
+        image.alpha_composite(overlay.convert("RGBA"))
+        if not self.running:
+            return self.empty_tile_image
+        image_tk = ImageTk.PhotoImage(image)
+        self.tile_image_cache[f"{zoom}{x}{y}"] = image_tk
+        return image_tk
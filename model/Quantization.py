@@ -0,0 +1,50 @@
+import copy
+
+import numpy as np
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+# Share of pixels on which INT8 masks are expected to match the float model
+MIN_AGREEMENT = 0.99
+
+
+def default_backend():
+    """ Picks the best quantized CPU engine available in this torch build. """
+    for backend in ('x86', 'fbgemm', 'qnnpack'):
+        if backend in torch.backends.quantized.supported_engines:
+            return backend
+    raise RuntimeError("This torch build has no quantized CPU engine.")
+
+
+def quantize_unet(model, calibration_batches, backend=None):
+    """
+    Returns a post-training static INT8 copy of a float unet for CPU inference.
+    FX graph mode fuses every Conv2d-BatchNorm2d-ReLU of DoubleConv, and with it of Down and Up,
+    into quantized conv-relu kernels. Activation ranges are observed on calibration_batches,
+    a non-empty iterable of NCHW float tensors.
+    """
+    backend = backend or default_backend()
+    torch.backends.quantized.engine = backend
+    float_model = copy.deepcopy(model).cpu().eval()
+    batches = list(calibration_batches)
+    prepared = prepare_fx(float_model, get_default_qconfig_mapping(backend), (batches[0],))
+    with torch.no_grad():
+        for batch in batches:
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+def mask_agreement(reference, candidate):
+    """ Fraction of pixels on which two class masks agree. """
+    return float(np.mean(np.asarray(reference) == np.asarray(candidate)))
+
+
+def quantization_agreement(float_model, quantized_model, batches):
+    """ Fraction of pixels of the NCHW batches on which both models predict the same class. """
+    agreements = []
+    with torch.no_grad():
+        for batch in batches:
+            agreements.append(mask_agreement(float_model(batch).argmax(dim=1),
+                                             quantized_model(batch).argmax(dim=1)))
+    return float(np.mean(agreements))
@@ -0,0 +1,106 @@
+"""
+ONNX Runtime backend for landslide detection.
+Imports neither torch nor the model code, so a build that only ships the exported
+.onnx file starts without loading the torch stack. Export the model with Predict.export_onnx.
+"""
+import os
+import threading
+
+import h5py
+import numpy as np
+
+import utils
+from data_processing import read_img, save_mask_file
+from tiling import TILE_OVERLAP, TILE_SIZE, TileAccumulator, iter_windows
+from tracing import array_info, span, traced
+
+ONNX_MODEL_PATH = utils.resource_path('exp/batch2500_F1_7383.onnx')
+
+
+class OnnxPredictor:
+    """
+    Holds an ONNX Runtime session with all graph optimizations enabled.
+    Calling the instance runs a forward pass on a NCHW float32 batch and returns the logits.
+    """
+
+    def __init__(self, model_path, intra_op_threads=0):
+        import onnxruntime  # Optional dependency, only needed for this backend
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+        self.model_path = model_path
+        with span("model_load", checkpoint=os.path.basename(model_path)):
+            self.session = onnxruntime.InferenceSession(
+                model_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.n_classes = self.session.get_outputs()[0].shape[1]
+
+    def __call__(self, image):
+        with span("forward", backend="onnx", **array_info(image)):
+            return self.session.run(None, {self.input_name: image})[0]
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_onnx_predictor(model_path=None):
+    """
+    Returns the cached OnnxPredictor for model_path (default: ONNX_MODEL_PATH),
+    rebuilt when the file on disk changes.
+    """
+    model_path = os.path.abspath(model_path or ONNX_MODEL_PATH)
+    key = (model_path, os.path.getmtime(model_path))
+    with _sessions_lock:
+        if key not in _sessions:
+            for stale in [k for k in _sessions if k[0] == model_path]:
+                del _sessions[stale]
+            _sessions[key] = OnnxPredictor(model_path)
+        return _sessions[key]
+
+
+def softmax(logits, axis=1):
+    """
+    Numerically stable softmax over the class axis
+    """
+    logits = logits - logits.max(axis=axis, keepdims=True)
+    np.exp(logits, out=logits)
+    logits /= logits.sum(axis=axis, keepdims=True)
+    return logits
+
+
+def predict_tiled(predictor, input_file, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, progress=None):
+    """
+    Same sliding-window inference as Predict.predict_tiled, run through ONNX Runtime
+    """
+    with h5py.File(input_file, 'r') as f:
+        dataset = f['img']
+        height, width = dataset.shape[0], dataset.shape[1]
+        accumulator = TileAccumulator(predictor.n_classes, height, width, overlap)
+        windows = list(iter_windows(height, width, tile_size, overlap))
+        for done, (row, col, tile_height, tile_width) in enumerate(windows, 1):
+            img = read_img(dataset, np.s_[row:row + tile_height, col:col + tile_width, :],
+                           dtype=np.float32)
+            batch = np.ascontiguousarray(img.transpose(2, 0, 1)[np.newaxis])
+            accumulator.add(softmax(predictor(batch))[0], row, col)
+            utils.report(progress, "Detecting landslides", done / len(windows))
+    return accumulator.mask()
+
+
+@traced("detection")
+def main(input_file, size, outputdir, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, model_path=None,
+         progress=None):
+    """
+    Runs detection on input_file with ONNX Runtime and writes <name>_mask.h5 to outputdir.
+    Takes the same arguments as Predict.main, tile_size=None runs the whole scene at once.
+    """
+    if not os.path.exists(outputdir):
+        os.makedirs(outputdir)
+    utils.report(progress, "Loading model")
+    predictor = get_onnx_predictor(model_path)
+    print('Testing..........')
+    if tile_size is None:
+        w, h = map(int, size.split(','))
+        tile_size = max(w, h)
+    pred = predict_tiled(predictor, input_file, tile_size, overlap, progress)
+    save_mask_file(input_file, pred, outputdir)
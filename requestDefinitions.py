@@ -1,46 +1,83 @@
 """
 These are the request JSON-Strings as well as evalution functions for the API calls.
 These have been kept simple as processing is done in python.
+The evalscripts are generated by build_evalscript, which also picks the sample type the
+bands are transferred in. decode_samples turns the received samples back into float32 values.
 """
-EVALSCRIPT_RGB_IMAGE = """
+from collections import namedtuple
+
+import numpy as np
+
+# value = stored * scale + offset. Integer sample types are rounded on encoding.
+BandEncoding = namedtuple("BandEncoding", ["sample_type", "scale", "offset"])
+FLOAT32 = BandEncoding("FLOAT32", 1.0, 0.0)
+# L1C digital numbers are integers below 2^16, so this is lossless at half the bytes
+DN_UINT16 = BandEncoding("UINT16", 1.0, 0.0)
+# Elevation in 0.2 m steps from -500 m to 12607 m, half the bytes of FLOAT32
+DEM_UINT16 = BandEncoding("UINT16", 0.2, -500.0)
+
+L1C_INPUT_BANDS = ["B01", "B02", "B03", "B04",
+                   "B05", "B06", "B07", "B08", "B8A", "B09", "B10", "B11", "B12"]
+# B08 is requested but not returned, the model was trained on these 12 bands
+L1C_OUTPUT_BANDS = ["B01", "B02", "B03", "B04",
+                    "B05", "B06", "B07", "B8A", "B09", "B10", "B11", "B12"]
+
+# Encodings used by the pipeline
+IMAGE_ENCODING = DN_UINT16
+DEM_ENCODING = FLOAT32
+
+
+def build_evalscript(input_bands, output_bands, encoding=FLOAT32, units=None):
+    """
+    Generates a VERSION=3 evalscript reading input_bands (in units, if given) and
+    returning output_bands stored as encoding
+    """
+    units_line = f'\n        units: "{units}",' if units else ""
+    if encoding.scale == 1 and encoding.offset == 0:
+        values = ", ".join(f"sample.{band}" for band in output_bands)
+    else:
+        shift = f"- {encoding.offset!r}" if encoding.offset >= 0 else f"+ {-encoding.offset!r}"
+        values = ", ".join(f"(sample.{band} {shift}) / {encoding.scale!r}"
+                           for band in output_bands)
+    if encoding.sample_type != "FLOAT32":
+        values = ", ".join(f"Math.round({value})" for value in values.split(", "))
+    bands = ", ".join(f'"{band}"' for band in input_bands)
+    return f"""
 //VERSION=3
-function setup() {
-  return {
+function setup() {{
+  return {{
     input: [
-      {
-        bands: ["B01", "B02", "B03", "B04", 
-        "B05", "B06", "B07", "B08", "B8A", "B09", "B10", "B11", "B12"],
-        units: "DN",
-      },
+      {{
+        bands: [{bands}],{units_line}
+      }},
     ],
-    output: {
-      bands: 12,
-      sampleType: SampleType.FLOAT32,
-    }
-  }
-}
-
-function evaluatePixel(sample) {
-  return [sample.B01, sample.B02, sample.B03, sample.B04, 
-  sample.B05, sample.B06, sample.B07, sample.B8A, sample.B09, sample.B10, sample.B11, sample.B12];
-}
+    output: {{
+      bands: {len(output_bands)},
+      sampleType: SampleType.{encoding.sample_type},
+    }}
+  }}
+}}
+
+function evaluatePixel(sample) {{
+  return [{values}];
+}}
 """
 
 
-EVALSCRIPT_DEM = """
-//VERSION=3
-function setup() {
-  return {
-    input: ["DEM"],
-    output: {
-      id: "default",
-      bands: 1,
-      sampleType: SampleType.FLOAT32,
-    },
-  }
-}
-
-function evaluatePixel(sample) {
-  return [sample.DEM]
-}
-"""
\ No newline at end of file
+def decode_samples(samples, encoding):
+    """
+    Returns the float32 values of samples received with encoding
+    """
+    values = np.asarray(samples, dtype=np.float32)
+    if encoding.scale != 1:
+        values *= np.float32(encoding.scale)
+    if encoding.offset != 0:
+        values += np.float32(encoding.offset)
+    return values
+
+
+EVALSCRIPT_RGB_IMAGE = build_evalscript(L1C_INPUT_BANDS, L1C_OUTPUT_BANDS, IMAGE_ENCODING,
+                                        units="DN")
+
+
+EVALSCRIPT_DEM = build_evalscript(["DEM"], ["DEM"], DEM_ENCODING)
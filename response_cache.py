@@ -0,0 +1,129 @@
+"""
+On-disk, content-addressed cache for Copernicus Process API responses.
+Entries are keyed by the SHA-256 of the canonical request body, which holds the bbox,
+time range, maxCloudCover, evalscript and output size, and evicted least recently used first.
+"""
+import hashlib
+import json
+import os
+import threading
+
+CACHE_DIR = os.path.expanduser("~/.LandslidePipeline_cache")
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+class ResponseCache:
+    """
+    Stores raw response bytes as <sha256>.bin files below directory.
+    The modification time of an entry is bumped on every hit and serves as LRU clock.
+    """
+
+    def __init__(self, directory=os.path.join(CACHE_DIR, "responses"),
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(request):
+        """
+        Content address of a request body
+        """
+        canonical = json.dumps(request, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".bin")
+
+    def get(self, request):
+        """
+        Returns the cached response bytes for request or None
+        """
+        path = self._path(self.key(request))
+        try:
+            with open(path, "rb") as file:
+                content = file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return content
+
+    def put(self, request, content):
+        """
+        Stores response bytes for request and evicts old entries above the size cap
+        """
+        path = self._path(self.key(request))
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(content)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith(".bin"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """
+        Deletes least recently used entries until the cache fits into max_bytes
+        """
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def clear(self):
+        """
+        Removes all entries and resets the counters
+        """
+        with self._lock:
+            for _, _, path in self._entries():
+                os.remove(path)
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Returns hit/miss counters as well as number and total size of entries
+        """
+        entries = self._entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+        }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Returns the process-wide ResponseCache, created on first use
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache()
+        return _default_cache
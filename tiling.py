@@ -0,0 +1,110 @@
+"""
+Tiling helpers for sliding-window inference.
+Kept free of torch so every inference backend can share them.
+"""
+import numpy as np
+
+TILE_SIZE = 512
+TILE_OVERLAP = 64
+
+
+def tile_origins(length, tile_size, overlap):
+    """
+    Returns the start offsets of the tiles along one axis.
+    The last tile is shifted back so it ends exactly at the border.
+    """
+    if tile_size >= length:
+        return [0]
+    stride = tile_size - overlap
+    if stride <= 0:
+        raise ValueError("Tile overlap has to be smaller than the tile size.")
+    origins = list(range(0, length - tile_size, stride))
+    origins.append(length - tile_size)
+    return origins
+
+
+def iter_windows(height, width, tile_size, overlap):
+    """
+    Yields (row, col, tile_height, tile_width) windows covering a height x width scene.
+    """
+    tile_height = min(tile_size, height)
+    tile_width = min(tile_size, width)
+    for row in tile_origins(height, tile_size, overlap):
+        for col in tile_origins(width, tile_size, overlap):
+            yield row, col, tile_height, tile_width
+
+
+def blend_weights(tile_height, tile_width, overlap):
+    """
+    Builds a 2D weight window that ramps up linearly over the overlap region,
+    so neighbouring tiles fade into each other instead of leaving seams.
+    """
+    def ramp(length):
+        weights = np.ones(length, dtype=np.float32)
+        edge = min(overlap, length // 2)
+        if edge > 0:
+            rising = (np.arange(edge, dtype=np.float32) + 1) / (edge + 1)
+            weights[:edge] = rising
+            weights[-edge:] = rising[::-1]
+        return weights
+
+    return np.outer(ramp(tile_height), ramp(tile_width))
+
+
+class TileAccumulator:
+    """
+    Collects weighted per-class tile probabilities and resolves them into the HxW mask.
+    Tiles have to be added row by row, in the order iter_windows yields them. Scores are
+    only kept for a band of rows one tile high: once a tile starts further down, the rows
+    above it can't receive scores anymore and are resolved into the uint8 mask.
+    Memory is n_classes float32 planes of tile height x scene width plus one byte per pixel.
+    """
+
+    def __init__(self, n_classes, height, width, overlap):
+        self.n_classes = n_classes
+        self.overlap = overlap
+        self.result = np.zeros((height, width), dtype=np.uint8)
+        self.band = np.zeros((n_classes, 0, width), dtype=np.float32)
+        self.band_start = 0
+        self._weights = {}
+
+    def _advance(self, row):
+        # Resolves the band rows above row and moves the band down to start at row
+        shift = row - self.band_start
+        if shift <= 0:
+            return
+        done = min(shift, self.band.shape[1])
+        self.result[self.band_start:self.band_start + done] = np.argmax(
+            self.band[:, :done], axis=0)
+        self.band[:, :self.band.shape[1] - done] = self.band[:, done:]
+        self.band[:, self.band.shape[1] - done:] = 0
+        self.band_start = row
+
+    def add(self, probabilities, row, col):
+        """
+        Blends a CHW probability tile into the scene at (row, col)
+        """
+        if row < self.band_start:
+            raise ValueError("Tiles have to be added row by row.")
+        _, tile_height, tile_width = probabilities.shape
+        self._advance(row)
+        missing = row + tile_height - self.band_start - self.band.shape[1]
+        if missing > 0:
+            self.band = np.concatenate(
+                (self.band, np.zeros((self.n_classes, missing, self.band.shape[2]),
+                                     dtype=np.float32)), axis=1)
+        key = (tile_height, tile_width)
+        if key not in self._weights:
+            self._weights[key] = blend_weights(tile_height, tile_width, self.overlap)
+        start = row - self.band_start
+        window = self.band[:, start:start + tile_height, col:col + tile_width]
+        window += probabilities * self._weights[key]
+
+    def mask(self):
+        """
+        Resolves the remaining rows and returns the HxW uint8 class mask.
+        Weights are strictly positive, so the argmax of the weighted sum equals
+        the argmax of the normalized blend.
+        """
+        self._advance(self.result.shape[0])
+        return self.result
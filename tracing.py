@@ -0,0 +1,211 @@
+"""
+Lightweight tracing of the pipeline stages.
+Spans record wall time, CPU time of the running thread and attributes such as bytes and
+array shapes. Nested spans on one thread show up nested in the trace viewer.
+The trace is exported in the Chrome trace event format, which chrome://tracing and
+https://ui.perfetto.dev open directly.
+Tracing is off unless enable() is called or LANDSLIDE_TRACE=<path.json> is set,
+in which case the trace is written to that path when the process exits.
+"""
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+
+_lock = threading.Lock()
+_events = []
+_origin = time.perf_counter()
+_enabled = False
+_export_path = None
+
+
+class Span:
+    """
+    Context manager measuring one traced section
+    """
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self._wall = None
+        self._cpu = None
+
+    def set(self, **attrs):
+        """
+        Adds attributes, e.g. sizes only known once the section ran
+        """
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        wall = time.perf_counter() - self._wall
+        cpu = time.thread_time() - self._cpu
+        args = dict(self.attrs)
+        args["cpu_ms"] = round(cpu * 1000, 3)
+        if exc_type is not None:
+            args["error"] = exc_type.__name__
+        event = {
+            "name": self.name,
+            "ph": "X",
+            "ts": (self._wall - _origin) * 1e6,
+            "dur": wall * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with _lock:
+            _events.append(event)
+        return False
+
+
+class _NullSpan:
+    """
+    Stand-in used while tracing is disabled, costs next to nothing
+    """
+
+    def set(self, **attrs):
+        """
+        Ignores attributes
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, **attrs):
+    """
+    Returns a context manager that records name with attrs while tracing is enabled
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name, attrs)
+
+
+def traced(name=None):
+    """
+    Decorator wrapping every call of a function in a span
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def array_info(array, prefix=""):
+    """
+    Span attributes describing a numpy array or tensor
+    """
+    info = {prefix + "shape": list(array.shape), prefix + "dtype": str(array.dtype)}
+    nbytes = getattr(array, "nbytes", None)
+    if nbytes is None and hasattr(array, "element_size"):
+        nbytes = array.element_size() * array.nelement()
+    if nbytes is not None:
+        info[prefix + "bytes"] = int(nbytes)
+    return info
+
+
+def enable(export_path=None):
+    """
+    Starts recording spans. With export_path the trace is written there at exit.
+    """
+    global _enabled, _export_path
+    _enabled = True
+    if export_path:
+        _export_path = export_path
+
+
+def disable():
+    """
+    Stops recording spans, already recorded events are kept
+    """
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    """
+    True while spans are recorded
+    """
+    return _enabled
+
+
+def disable_export():
+    """
+    Keeps recording but never writes the trace at exit, for worker processes
+    that hand their events to the parent (see merge_events)
+    """
+    global _export_path
+    _export_path = None
+
+
+def origin():
+    """
+    perf_counter value the timestamps of this process are relative to
+    """
+    return _origin
+
+
+def merge_events(events, event_origin):
+    """
+    Adds events recorded by another process whose timestamps are relative to event_origin.
+    perf_counter is a system-wide monotonic clock, so the spans line up with the local ones.
+    """
+    shift = (event_origin - _origin) * 1e6
+    with _lock:
+        _events.extend(dict(event, ts=event["ts"] + shift) for event in events)
+
+
+def reset():
+    """
+    Drops all recorded events
+    """
+    with _lock:
+        _events.clear()
+
+
+def events():
+    """
+    Returns a copy of the recorded events
+    """
+    with _lock:
+        return list(_events)
+
+
+def export_chrome_trace(path):
+    """
+    Writes all recorded events as Chrome trace JSON and returns the path
+    """
+    with _lock:
+        trace = {"traceEvents": list(_events), "displayTimeUnit": "ms"}
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(trace, file)
+    return path
+
+
+def _export_at_exit():
+    if _export_path and _events:
+        export_chrome_trace(_export_path)
+        print(f"Trace written to {_export_path}")
+
+
+atexit.register(_export_at_exit)
+
+if os.environ.get("LANDSLIDE_TRACE"):
+    enable(os.environ["LANDSLIDE_TRACE"])
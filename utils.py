@@ -4,60 +4,143 @@ This module provides utility functions for the app
 """
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import requests
 
-from copernicus_api import authenticate_with_copernicus, fetch_dem_data, fetch_sentinel_data_image
-from data_processing import (concatenate_dem_and_image,
+from catalog import acquisition_window, find_acquisitions
+from copernicus_api import (authenticate_with_copernicus, fetch_dem_data,
+                            fetch_sentinel_data_image, output_grid)
+from data_processing import (compute_slope, concatenate_dem_and_image, load_base_data,
                              visualize_as_tiles_np_array, visualize_as_tiles_h5)
-from requestDefinitions import EVALSCRIPT_DEM, EVALSCRIPT_RGB_IMAGE
+from geocoding import geocode
+from requestDefinitions import DEM_ENCODING, EVALSCRIPT_DEM, EVALSCRIPT_RGB_IMAGE, IMAGE_ENCODING
+from tracing import span, traced
 
 
 
 def get_bbox_for_city(city_name):
     """
-    This function gets the bounding box of a WKN
-    by calling the calling the nominatim API using secrets_app.
+    Returns lat, lon of a WKN, looked up through the cached and rate-limited
+    geocoding module, which also provides its bbox and outline (geocoding.geocode)
     """
-    geocode_url = (f"https://nominatim.openstreetmap.org/search?q={city_name}"
-                   f"&format=json&polygon_geojson=1")
-    headers = {'User-Agent':'Landslide-Thesis|ma3608@mci4me.at'}
-    response = requests.get(geocode_url, headers=headers, timeout=100)
-    if response.status_code == 200:
-        data = response.json()
-        if len(data) > 0:
-            bbox = data[0]['boundingbox']
-            print(bbox)
-            return float(data[0]['lat']), float(data[0]['lon'])
-        raise ValueError("City not found in geocoding service.")
-    raise requests.exceptions.HTTPError(
-        f"Error fetching bbox: {response.status_code}")
-
-
-def call_for_data(bbox, starttime, enddtime, cloudpercentage, path=''):
+    place = geocode(city_name)
+    return place.lat, place.lon
+
+
+def fetch_dem_with_slope(oauth, bbox, grid=None, progress=None):
     """
-    uses a provided bounding box to call the Sentinel-API
+    Fetches the DEM for bbox (on grid, if given) and derives the slope band from it.
+    progress(done, total) is called per DEM tile or sub-request, see fetch_dem_data.
+    """
+    print("Fetching Sentinel-2 DEM Image")
+    with span("fetch_dem"):
+        dem = np.array(fetch_dem_data(oauth, bbox, EVALSCRIPT_DEM, False, grid=grid,
+                                      encoding=DEM_ENCODING, progress=progress))
+    return dem, compute_slope(dem)
+
+
+def best_acquisition_window(oauth, bbox, starttime, enddtime, cloudpercentage, progress=None):
+    """
+    Looks up the Sentinel-2 acquisitions in the time window in the catalog and returns
+    the day of the best one, or the whole window if the catalog lists none or is unavailable
+    """
+    try:
+        acquisitions = find_acquisitions(oauth, bbox, starttime, enddtime, cloudpercentage)
+    except requests.RequestException as e:
+        print(f"Catalog search failed, using the whole time window: {e}")
+        return starttime, enddtime
+    if not acquisitions:
+        return starttime, enddtime
+    best = acquisitions[0]
+    print(f"Using acquisition of {best.date} ({best.cloud_cover:.1f}% clouds, "
+          f"{best.coverage:.0%} coverage) out of {len(acquisitions)}")
+    report(progress, f"Downloading Sentinel-2 imagery of {best.date}")
+    return acquisition_window(best)
+
+
+def fetch_concurrently(oauth, bbox, starttime, enddtime, cloudpercentage, progress=None,
+                       best_acquisition=True):
+    """
+    Issues the DEM and the Sentinel-2 request at the same time, both on one output grid.
+    The slope is computed as soon as the DEM arrives, while the imagery is still downloading.
+    With best_acquisition only the best single acquisition in the time window is downloaded
+    instead of a mosaic of all of them.
+    progress is reported after every finished sub-request, a progress that raises
+    (on cancel) drops the sub-requests that were not sent yet.
+    Returns dem, slope and image data as numpy arrays.
+    """
+    grid = output_grid(bbox)
+    fractions = {"dem": 0.0, "image": 0.0}
+
+    def report_part(part):
+        def progress_part(done, total):
+            fractions[part] = done / total
+            report(progress, "Downloading DEM and Sentinel-2 imagery",
+                   (fractions["dem"] + fractions["image"]) / 2)
+        return progress_part
+
+    def fetch_image():
+        start, end = starttime, enddtime
+        if best_acquisition:
+            start, end = best_acquisition_window(oauth, bbox, starttime, enddtime,
+                                                 cloudpercentage, progress)
+        with span("fetch_sentinel_image"):
+            return fetch_sentinel_data_image(oauth, bbox, EVALSCRIPT_RGB_IMAGE, start,
+                                             end, cloudpercentage, grid=grid,
+                                             encoding=IMAGE_ENCODING,
+                                             progress=report_part("image"))
 
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        dem_future = executor.submit(fetch_dem_with_slope, oauth, bbox, grid,
+                                     report_part("dem"))
+        print("Fetching Sentinel-2 RGB Image")
+        image_future = executor.submit(fetch_image)
+        dem, slope = dem_future.result()
+        image_data = np.array(image_future.result())
+    return dem, slope, image_data
+
+
+def report(progress, stage, fraction=None):
+    """
+    Forwards a stage to an optional progress(stage, fraction) callback.
+    The callback may raise to cancel the running job.
+    """
+    if progress is not None:
+        progress(stage, fraction)
+
+
+@traced()
+def call_for_data(bbox, starttime, enddtime, cloudpercentage, path='', progress=None,
+                  visualize=True):
+    """
+    uses a provided bounding box to call the Sentinel-API
+    progress(stage, fraction) is called at every stage, visualize=False skips the figure
+    and returns (None, data), e.g. when the figure has to be drawn on another thread.
     """
     if path == '':
         try:
+            report(progress, "Authenticating with Copernicus API")
             print("Authenticating with Copernicus API...")
             oauth = authenticate_with_copernicus()
-            print("Fetching Sentinel-2 DEM Image")
-
-            dem = np.array(fetch_dem_data(oauth, bbox, EVALSCRIPT_DEM, False))
-            print("Fetching Sentinel-2 RGB Image")
-            image_data = np.array(
-                fetch_sentinel_data_image(oauth, bbox, EVALSCRIPT_RGB_IMAGE, starttime, enddtime,
-                                          cloudpercentage))
-            data = concatenate_dem_and_image(dem, image_data)
+            report(progress, "Downloading DEM and Sentinel-2 imagery", 0.0)
+            dem, slope, image_data = fetch_concurrently(oauth, bbox, starttime, enddtime,
+                                                        cloudpercentage, progress)
+            report(progress, "Stacking bands")
+            data = concatenate_dem_and_image(dem, image_data, slope=slope)
+            if not visualize:
+                return None, data
+            report(progress, "Rendering preview")
             figure = visualize_as_tiles_np_array(data)
             return figure, data
         except PermissionError as e:
             print(f"Error: {e}")
             return None, None
     else:
+        if not visualize:
+            report(progress, "Reading " + os.path.basename(path))
+            return None, load_base_data(path)
         figure, data = visualize_as_tiles_h5(path)
         return figure, data
 
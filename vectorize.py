@@ -0,0 +1,270 @@
+"""
+Turns a landslide mask into polygons with per-landslide statistics.
+Connected components of the mask are labeled, their area, centroid, mean slope and elevation
+are computed in one pass over the bands, and the outlines are traced along pixel edges.
+The features are written as GeoJSON (WGS84) or, if fiona is installed, as GeoPackage.
+"""
+import json
+
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+from data_processing import IMG_MEAN
+from georeference import WGS84, get_transformer
+from tracing import array_info, span
+
+# Bands of the stacked AxBx14 data
+SLOPE_BAND = 12
+ELEVATION_BAND = 13
+# Decimal places of the exported lon/lat coordinates, 1e-7 degrees is about 1 cm
+COORDINATE_DECIMALS = 7
+
+# Edge directions east, south, west, north as (row, col) steps. Outlines run clockwise on
+# screen, so turning right means (direction + 1) % 4.
+_STEPS = np.array([(0, 1), (1, 0), (0, -1), (-1, 0)])
+
+
+def label_mask(mask):
+    """
+    Labels the 4-connected landslide areas of an AxB(x1) mask.
+    Returns the AxB int32 label image and the number of labels.
+    """
+    mask = np.asarray(mask).reshape(mask.shape[:2])
+    labels, count = ndimage.label(mask > 0)
+    return labels.astype(np.int32, copy=False), count
+
+
+def component_statistics(labels, count, grid, base_data=None, normalized=False):
+    """
+    Per label 1..count: pixel count, area in m², centroid (easting, northing) on grid
+    and, with base_data, mean slope and elevation.
+    normalized tells that base_data was divided by the training mean, as the .h5 input files are.
+    Returns a dict of arrays of length count.
+    """
+    index = np.arange(1, count + 1)
+    pixels = np.bincount(labels.ravel(), minlength=count + 1)[1:]
+    centers = np.array(ndimage.center_of_mass(labels > 0, labels, index)).reshape(-1, 2)
+    # Pixel centers lie half a pixel inside the grid corners
+    rows, cols = centers[:, 0] + 0.5, centers[:, 1] + 0.5
+    stats = {
+        "pixels": pixels,
+        "area_m2": pixels * float(grid.resolution) ** 2,
+        "easting": grid.minx + cols * grid.resolution,
+        "northing": grid.maxy - rows * grid.resolution,
+    }
+    if base_data is not None:
+        for name, band in (("mean_slope", SLOPE_BAND), ("mean_elevation", ELEVATION_BAND)):
+            mean = ndimage.mean(base_data[:, :, band], labels, index)
+            stats[name] = mean * IMG_MEAN[band] if normalized else mean
+    return stats
+
+
+def _boundary_edges(labels):
+    """
+    Returns start vertex (row, col), direction and label of every pixel edge between
+    different labels, oriented so that the labeled pixel is on the right
+    """
+    padded = np.pad(labels, 1)
+    inner = padded[1:-1, 1:-1]
+    neighbours = (padded[:-2, 1:-1], padded[1:-1, 2:], padded[2:, 1:-1], padded[1:-1, :-2])
+    # Start corner of the top, right, bottom and left edge of a pixel, relative to it
+    starts = ((0, 0), (0, 1), (1, 1), (1, 0))
+    rows, cols, directions, edge_labels = [], [], [], []
+    for direction, (neighbour, (row_offset, col_offset)) in enumerate(zip(neighbours, starts)):
+        r, c = np.nonzero((inner > 0) & (inner != neighbour))
+        rows.append(r + row_offset)
+        cols.append(c + col_offset)
+        directions.append(np.full(r.size, direction))
+        edge_labels.append(inner[r, c])
+    return (np.concatenate(rows), np.concatenate(cols), np.concatenate(directions),
+            np.concatenate(edge_labels))
+
+
+def _trace_rings(labels):
+    """
+    Chains the boundary edges into closed rings and keeps only their corners.
+    Returns corner rows and cols with all rings one after another, the offsets of the rings
+    into them (length rings + 1), the label and the signed area of every ring.
+    Outlines run clockwise on screen and have a positive area, holes a negative one.
+    """
+    rows, cols, directions, edge_labels = _boundary_edges(labels)
+    count = rows.size
+    width = labels.shape[1] + 1
+    start = rows * width + cols
+    end = (rows + _STEPS[directions, 0]) * width + cols + _STEPS[directions, 1]
+
+    # Successor of every edge: the edge leaving its end vertex. Where two edges leave a vertex
+    # (diagonally touching pixels) the right turn is taken, which keeps 4-connected areas apart.
+    order = np.lexsort((directions, start))
+    sorted_start = start[order]
+    first = np.searchsorted(sorted_start, end, side='left')
+    successor = order[first]
+    pinched = np.nonzero(np.searchsorted(sorted_start, end, side='right') - first > 1)[0]
+    right_turn = (directions[pinched] + 1) % 4
+    # Both candidates are sorted by direction, take the second one unless the first turns right
+    successor[pinched] = np.where(directions[order[first[pinched]]] == right_turn,
+                                  order[first[pinched]], order[first[pinched] + 1])
+
+    # Successors form a permutation, its cycles are the rings
+    edges = np.arange(count)
+    ring_count, ring_of = connected_components(
+        csr_matrix((np.ones(count, dtype=np.int8), (edges, successor)), shape=(count, count)),
+        directed=True, connection='weak')
+    # Cut every ring after its lowest edge and rank the edges by pointer jumping,
+    # rank = number of steps to the end of the ring
+    head = np.full(ring_count, count)
+    np.minimum.at(head, ring_of, edges)
+    predecessor = np.empty(count, dtype=np.intp)
+    predecessor[successor] = edges
+    tails = predecessor[head]
+    jump = np.append(successor, count)
+    jump[tails] = count
+    rank = np.ones(count + 1, dtype=np.intp)
+    rank[tails] = 0
+    rank[count] = 0
+    while (jump[:count] != count).any():
+        rank = rank + rank[jump]
+        jump = jump[jump]
+    walk = np.lexsort((-rank[:count], ring_of))
+
+    # Only corners are kept, collinear vertices along straight runs are dropped
+    ring_sizes = np.bincount(ring_of, minlength=ring_count)
+    ring_starts = np.cumsum(ring_sizes) - ring_sizes
+    previous = edges - 1
+    previous[ring_starts] = ring_starts + ring_sizes - 1
+    walk_directions = directions[walk]
+    corners = walk[walk_directions != walk_directions[previous]]
+    corner_rows, corner_cols = rows[corners], cols[corners]
+    corner_rings = ring_of[corners]
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(corner_rings, minlength=ring_count))))
+
+    following = np.arange(1, corners.size + 1)
+    following[offsets[1:] - 1] = offsets[:-1]
+    cross = (corner_cols * corner_rows[following]
+             - corner_cols[following] * corner_rows).astype(np.float64)
+    areas = 0.5 * np.add.reduceat(cross, offsets[:-1]) if corners.size else cross
+    return corner_rows, corner_cols, offsets, edge_labels[corners[offsets[:-1]]], areas
+
+
+def _contains(rows, cols, point):
+    """
+    Even-odd test whether point (row, col) lies inside the ring with corners rows, cols
+    """
+    rows, cols = rows.astype(float), cols.astype(float)
+    next_rows, next_cols = np.roll(rows, -1), np.roll(cols, -1)
+    crosses = (rows > point[0]) != (next_rows > point[0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        at = cols + (point[0] - rows) * (next_cols - cols) / (next_rows - rows)
+    return bool(np.count_nonzero(crosses & (point[1] < at)) % 2)
+
+
+def vectorize_mask(mask, grid, base_data=None, normalized=False, min_pixels=1):
+    """
+    Converts an AxB(x1) mask on grid (georeference.OutputGrid) into GeoJSON features,
+    one per landslide of at least min_pixels pixels, in WGS84 lon/lat.
+    Properties are id, pixels, area_m2, centroid_lon, centroid_lat and,
+    with the AxBx14 base_data, mean_slope and mean_elevation.
+    """
+    with span("vectorize_mask", **array_info(mask)):
+        labels, count = label_mask(mask)
+        if count == 0:
+            return []
+        stats = component_statistics(labels, count, grid, base_data, normalized)
+        keep = np.concatenate(([False], stats["pixels"] >= min_pixels))
+        labels[~keep[labels]] = 0
+        if not keep.any():
+            return []
+
+        rows, cols, offsets, ring_labels, areas = _trace_rings(labels)
+        to_wgs84 = get_transformer(grid.epsg, WGS84)
+        lon, lat = to_wgs84.transform(grid.minx + cols * grid.resolution,
+                                      grid.maxy - rows * grid.resolution)
+        lonlat = np.round(np.column_stack((lon, lat)), COORDINATE_DECIMALS).tolist()
+        centroid_lon, centroid_lat = to_wgs84.transform(stats["easting"], stats["northing"])
+
+        def ring_coordinates(ring):
+            coordinates = lonlat[offsets[ring]:offsets[ring + 1]]
+            # GeoJSON wants exteriors counter-clockwise, the traced ones run clockwise
+            coordinates.append(coordinates[0])
+            coordinates.reverse()
+            return coordinates
+
+        features = []
+        rings_by_label = np.argsort(ring_labels, kind='stable')
+        bounds = np.searchsorted(ring_labels[rings_by_label], np.arange(1, count + 2))
+        for label in np.nonzero(keep)[0]:
+            rings = rings_by_label[bounds[label - 1]:bounds[label]]
+            exteriors = rings[areas[rings] > 0]
+            polygons = [[exterior] for exterior in exteriors]
+            for hole in rings[areas[rings] <= 0]:
+                owner = polygons[0]
+                if len(polygons) > 1:
+                    point = (rows[offsets[hole]] + 0.5, cols[offsets[hole]] + 0.5)
+                    owner = next((polygon for polygon in polygons if _contains(
+                        rows[offsets[polygon[0]]:offsets[polygon[0] + 1]],
+                        cols[offsets[polygon[0]]:offsets[polygon[0] + 1]], point)), owner)
+                owner.append(hole)
+            polygons = [[ring_coordinates(ring) for ring in polygon] for polygon in polygons]
+            geometry = ({"type": "Polygon", "coordinates": polygons[0]} if len(polygons) == 1
+                        else {"type": "MultiPolygon", "coordinates": polygons})
+            i = label - 1
+            properties = {
+                "id": int(label),
+                "pixels": int(stats["pixels"][i]),
+                "area_m2": float(stats["area_m2"][i]),
+                "centroid_lon": round(float(centroid_lon[i]), COORDINATE_DECIMALS),
+                "centroid_lat": round(float(centroid_lat[i]), COORDINATE_DECIMALS),
+            }
+            for name in ("mean_slope", "mean_elevation"):
+                if name in stats:
+                    properties[name] = round(float(stats[name][i]), 3)
+            features.append({"type": "Feature", "geometry": geometry, "properties": properties})
+    return features
+
+
+def write_geojson(features, path):
+    """
+    Writes features as a GeoJSON FeatureCollection and returns the path
+    """
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({"type": "FeatureCollection", "features": features}, file,
+                  separators=(",", ":"))
+    return path
+
+
+def write_geopackage(features, path, layer="landslides"):
+    """
+    Writes features to a GeoPackage layer and returns the path.
+    Needs the optional fiona package.
+    """
+    try:
+        import fiona  # pylint: disable=import-outside-toplevel
+    except ImportError as e:
+        raise ImportError("GeoPackage export needs fiona: pip install fiona") from e
+    properties = {name: ("int" if name in ("id", "pixels") else "float")
+                  for name in (features[0]["properties"] if features else {"id": 0})}
+    schema = {"geometry": "MultiPolygon", "properties": properties}
+    with fiona.open(path, "w", driver="GPKG", crs="EPSG:4326", schema=schema,
+                    layer=layer) as sink:
+        for feature in features:
+            geometry = feature["geometry"]
+            coordinates = (geometry["coordinates"] if geometry["type"] == "MultiPolygon"
+                           else [geometry["coordinates"]])
+            sink.write({"geometry": {"type": "MultiPolygon", "coordinates": coordinates},
+                        "properties": feature["properties"]})
+    return path
+
+
+def export_polygons(mask, grid, path, base_data=None, normalized=False, min_pixels=1):
+    """
+    Vectorizes mask and writes the features to path, GeoPackage for .gpkg, GeoJSON otherwise.
+    Returns the number of features written.
+    """
+    features = vectorize_mask(mask, grid, base_data, normalized, min_pixels)
+    if path.lower().endswith(".gpkg"):
+        write_geopackage(features, path)
+    else:
+        write_geojson(features, path)
+    return len(features)
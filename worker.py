@@ -0,0 +1,141 @@
+"""
+Background execution for long running GUI work.
+Jobs run on a worker thread, progress and results are handed back to the Tk main loop,
+which polls for them with after() and therefore stays responsive.
+map_concurrently runs the parallel parts of a job so that a cancel stops them early.
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class CancelledError(Exception):
+    """
+    Raised inside a job once the user cancelled it
+    """
+
+
+def map_concurrently(func, items, max_workers, progress=None):
+    """
+    Returns [func(item) for item in items], computed on up to max_workers threads.
+    progress(done, total) is called after every finished item and may raise, e.g.
+    CancelledError. On any error the items that did not start yet are dropped and only
+    the calls already running are waited for before the error is raised.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items))))
+    try:
+        futures = {executor.submit(func, item): index for index, item in enumerate(items)}
+        for done, future in enumerate(as_completed(futures), 1):
+            results[futures[future]] = future.result()
+            if progress is not None:
+                progress(done, len(items))
+    except BaseException:
+        executor.shutdown(cancel_futures=True)
+        raise
+    executor.shutdown()
+    return results
+
+
+class TaskContext:
+    """
+    Handed to every job. progress doubles as cancellation point:
+    it raises CancelledError once cancel() was called on the task.
+    """
+
+    def __init__(self, events, cancel_event):
+        self._events = events
+        self._cancel_event = cancel_event
+
+    @property
+    def cancelled(self):
+        """
+        True once the task was cancelled
+        """
+        return self._cancel_event.is_set()
+
+    def check_cancelled(self):
+        """
+        Raises CancelledError if the task was cancelled
+        """
+        if self.cancelled:
+            raise CancelledError()
+
+    def progress(self, stage, fraction=None):
+        """
+        Reports the current stage and, if known, its completed fraction between 0 and 1
+        """
+        self.check_cancelled()
+        self._events.put(("progress", (stage, fraction)))
+
+
+class BackgroundTask:
+    """
+    Runs job(context, *args) on a daemon thread.
+    All callbacks are invoked on the Tk main thread:
+    on_progress(stage, fraction), on_done(result), on_error(exception) and on_cancel().
+    """
+    POLL_MS = 100
+
+    def __init__(self, widget, job, args=(), on_progress=None, on_done=None, on_error=None,
+                 on_cancel=None):
+        self.widget = widget
+        self.job = job
+        self.args = args
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_cancel = on_cancel
+        self._events = queue.Queue()
+        self._cancel_event = threading.Event()
+        self._thread = None
+        self.finished = False
+
+    def start(self):
+        """
+        Starts the job and begins polling for its events
+        """
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self.widget.after(self.POLL_MS, self._poll)
+        return self
+
+    def cancel(self):
+        """
+        Asks the job to stop at its next progress report
+        """
+        self._cancel_event.set()
+
+    def _run(self):
+        context = TaskContext(self._events, self._cancel_event)
+        try:
+            result = self.job(context, *self.args)
+            if self._cancel_event.is_set():
+                self._events.put(("cancelled", None))
+            else:
+                self._events.put(("done", result))
+        except CancelledError:
+            self._events.put(("cancelled", None))
+        except Exception as e:  # pylint: disable=broad-except
+            self._events.put(("error", e))
+
+    def _poll(self):
+        try:
+            while True:
+                kind, payload = self._events.get_nowait()
+                if kind == "progress":
+                    if self.on_progress:
+                        self.on_progress(*payload)
+                    continue
+                self.finished = True
+                if kind == "done" and self.on_done:
+                    self.on_done(payload)
+                elif kind == "error" and self.on_error:
+                    self.on_error(payload)
+                elif kind == "cancelled" and self.on_cancel:
+                    self.on_cancel()
+                return
+        except queue.Empty:
+            pass
+        self.widget.after(self.POLL_MS, self._poll)